@@ -5,6 +5,16 @@ from copy import deepcopy
 from collections import defaultdict
 from operator import itemgetter
 import re
+import numpy as np
+from ocrpage import OCRPage
+
+# No word is taller than this, we presume
+maxy = 100
+# what is the minimum overlap threshold to consider?
+othresh = 0.2
+# how many words of the master page to match against at once in
+# merge_ocr_page_arrays_match
+match_block = 256
 
 
 def find_bbox_overlap(bbox1, bbox2):
@@ -50,8 +60,14 @@ def merge_ocr_pages(pages, debug=False):
 
     We do this by adding a new element to each word's dict containing
     a dict of options.
+
+    If the first page is an OCRPage, the pages are merged using
+    merge_ocr_page_arrays instead, which gives the same results.
     """
 
+    if isinstance(pages[0], OCRPage):
+        return merge_ocr_page_arrays(pages, debug)
+
     page1copy = deepcopy(pages[0])
     for a in page1copy['areas']:
         for p in a['pars']:
@@ -108,10 +124,6 @@ def merge_ocr_pages_match(page1, words1, page2, debug=False, tracing=False):
     # We do not need to start at the beginning of words2 each time
     # as the y values increase, so this records where we start
     start = 0
-    # No word is taller than this, we presume
-    maxy = 100
-    # what is the minimum overlap threshold to consider?
-    othresh = 0.2
 
     for w in words1:
         for i2 in range(start, len(words2)):
@@ -207,6 +219,189 @@ def merge_ocr_pages_pick_best(words, debug=False):
         w['idused'] = maxconfw['id']
 
 
+def merge_ocr_page_arrays(pages, debug=False):
+    """Merges a sequence of OCRPages
+
+    This is the same as merge_ocr_pages, but works directly on the
+    arrays of the OCRPages; the pages may also be tidied pages, which
+    are converted to OCRPages first.  The merged page does not record
+    the 'readings' of each word.
+    """
+
+    pages = [p if isinstance(p, OCRPage) else OCRPage.from_dict(p)
+             for p in pages]
+    page1copy = pages[0].copy()
+    # words1 is the words of page1copy in order of increasing upper y
+    # coordinate; Python's sort is stable, so we ask for the same here
+    words1 = np.argsort(page1copy.bboxes['word'][:, 1], kind='stable')
+
+    # The index of the matching word on each page (-1 if there is
+    # none) for each word in words1
+    matches = [words1]
+    for page in pages[1:]:
+        matches.append(merge_ocr_page_arrays_match(page1copy, words1,
+                                                   page, debug))
+
+    merge_ocr_page_arrays_pick_best(page1copy, words1, pages, matches,
+                                    debug)
+
+    return page1copy
+
+
+def merge_ocr_page_arrays_match(page1, words1, page2, debug=False):
+    """Matches the words of two OCRPages
+
+    Input: page1: master page
+           words1: the indices of the page1 words, sorted by upper y
+           page2: new page to match to page1
+
+    Returns an array giving the index of the page2 word matched to
+    each word in words1, or -1 if there is none.  As in
+    merge_ocr_pages_match, each word in words1 is matched in turn with
+    the first unmatched word of page2 (in order of upper y) which
+    overlaps it sufficiently.
+    """
+
+    bbox1 = page1.bboxes['word'][words1].astype(np.int64)
+    words2 = np.argsort(page2.bboxes['word'][:, 1], kind='stable')
+    bbox2 = page2.bboxes['word'][words2].astype(np.int64)
+    area1 = (bbox1[:, 2] - bbox1[:, 0]) * (bbox1[:, 3] - bbox1[:, 1])
+    area2 = (bbox2[:, 2] - bbox2[:, 0]) * (bbox2[:, 3] - bbox2[:, 1])
+    top2 = bbox2[:, 1]
+
+    matched = np.full(len(words1), -1, dtype=np.int64)
+    used = np.zeros(len(words2), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for b in range(0, len(words1), match_block):
+            bb1 = bbox1[b:b + match_block]
+            ba1 = area1[b:b + match_block]
+            # the words2 which could match any word in this block
+            lo = np.searchsorted(top2, bb1[:, 1].min() - maxy, 'left')
+            hi = np.searchsorted(top2, bb1[:, 3].max(), 'right')
+            # The window can be large if many words have the same y
+            # coordinates, so we work through its unmatched words in
+            # chunks, stopping once every word in the block has been
+            # matched.  As each word takes the first available match,
+            # and the words are matched in order within each chunk,
+            # this gives the same result as working through the whole
+            # window at once.
+            cols = lo + np.flatnonzero(~used[lo:hi])
+            rows = np.arange(len(bb1))
+            for c in range(0, len(cols), match_block):
+                chunk = cols[c:c + match_block]
+                l1, t1, r1, b1 = (bb1[rows, i, None] for i in range(4))
+                l2, t2, r2, b2 = (bbox2[None, chunk, i] for i in range(4))
+                area0 = ((np.minimum(r1, r2) - np.maximum(l1, l2)) *
+                         (np.minimum(b1, b2) - np.maximum(t1, t2)))
+                valid = ((t2 + maxy >= t1) & (t2 <= b1) &
+                         (r2 > l1) & (r1 > l2) & (b1 > t2) & (b2 > t1) &
+                         (area0 / ba1[rows, None] >= othresh) &
+                         (area0 / area2[None, chunk] >= othresh))
+
+                # Most words have only one candidate, so this is short
+                matchedrows = np.zeros(len(rows), dtype=bool)
+                for i in np.flatnonzero(valid.any(axis=1)):
+                    candidates = chunk[valid[i] & ~used[chunk]]
+                    if len(candidates):
+                        used[candidates[0]] = True
+                        matched[b + rows[i]] = words2[candidates[0]]
+                        matchedrows[i] = True
+                rows = rows[~matchedrows]
+                if not len(rows):
+                    break
+
+    # We don't know how to merge in remaining words.
+    # So we'll just report them for now.
+    if debug:
+        print('Words left out during run of merge_ocr_page_arrays_match:')
+        for i in words2[~used]:
+            print('Word: %s, id: %s, conf: %d, bbox: %s' %
+                  (page2.strings[page2.words[i]],
+                   page2.strings[page2.ids['word'][i]], page2.conf[i],
+                   page2.bboxes['word'][i].tolist()))
+
+    return matched
+
+
+def merge_ocr_page_arrays_pick_best(page, words1, pages, matches,
+                                    debug=False):
+    """Chooses the "best" option for each word of page
+
+    Input: page: the master page, which is modified
+           words1: the indices of the words of page
+           pages: the pages being merged, the first being the
+                  original of page
+           matches: the indices of the matching word in each of the
+                    pages for each of words1, or -1 if there is none
+
+    This makes the same choice as merge_ocr_pages_pick_best: the
+    reading with the greatest total modconf (the first such in the
+    order in which the readings were found), and the occurrence of
+    that reading with the greatest conf (again, the first such).
+    """
+
+    npages = len(pages)
+    nwords = len(words1)
+    if nwords == 0:
+        page.idused = np.zeros(0, dtype=np.int32)
+        return
+
+    # the word and id of each candidate as indices into page.strings,
+    # and their confidences, as nwords x npages arrays
+    found = np.stack([m >= 0 for m in matches], axis=1)
+    cand = np.stack([np.where(m >= 0, m, 0) for m in matches], axis=1)
+    words = np.full((nwords, npages), -1, dtype=np.int64)
+    ids = np.zeros((nwords, npages), dtype=np.int64)
+    conf = np.zeros((nwords, npages), dtype=np.int64)
+    modconf = np.zeros((nwords, npages), dtype=np.int64)
+    for p, other in enumerate(pages):
+        if other.nwords == 0:
+            continue
+        strmap = np.array([page.intern(s) for s in other.strings],
+                          dtype=np.int64)
+        c = cand[:, p]
+        words[:, p] = np.where(found[:, p], strmap[other.words[c]], -1)
+        ids[:, p] = strmap[other.ids['word'][c]]
+        conf[:, p] = other.conf[c]
+        modconf[:, p] = other.modconf[c]
+
+    # same[i, p, q] is True if candidates p and q of word i are both
+    # present and are the same reading
+    same = ((words[:, :, None] == words[:, None, :]) &
+            found[:, :, None] & found[:, None, :])
+    totalconf = np.where(found, (same * modconf[:, None, :]).sum(axis=2), -1)
+    # argmax picks the first of several maxima, which is the first
+    # reading found of those with the highest total confidence
+    best = np.argmax(totalconf, axis=1)
+    rows = np.arange(nwords)
+    inreading = same[rows, best]
+    bestconf = np.argmax(np.where(inreading, conf, -1), axis=1)
+
+    chosen = (rows, bestconf)
+    src = cand[chosen]
+    if debug:
+        for i in range(nwords):
+            w = words1[i]
+            print('replacing word: id = %s, w = %s, dictconf = %d\n' %
+                  (page.strings[page.ids['word'][w]],
+                   page.strings[page.words[w]], page.dictconf[w]))
+            other = pages[bestconf[i]]
+            print('with: id = %s, w = %s, dictconf = %d\n' %
+                  (other.strings[other.ids['word'][src[i]]],
+                   other.strings[other.words[src[i]]],
+                   other.dictconf[src[i]]))
+
+    page.words[words1] = words[chosen]
+    page.conf[words1] = conf[chosen]
+    page.modconf[words1] = modconf[chosen]
+    page.idused = np.zeros(len(page.words), dtype=np.int32)
+    page.idused[words1] = ids[chosen]
+    for p, other in enumerate(pages):
+        sel = bestconf == p
+        page.bboxes['word'][words1[sel]] = other.bboxes['word'][src[sel]]
+        page.dictconf[words1[sel]] = other.dictconf[src[sel]]
+
+
 def update_hocr(hocr, page, debug=False):
     """Update the hOCR string with the current best text in page
 
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compare the LuaLaTeX and FreeType renderers in textimages.
+
+This renders each line of a text file with both renderers, reporting
+the rendering speed (lines per second) of each and how different the
+resulting images are, both at the rendering resolution and after
+scaling down to the low resolution (with no random offset or noise).
+
+The pixel differences are calculated after aligning the two images at
+their top left corners (both are cropped to the ink plus a border) and
+padding them with white to the same size.
+"""
+
+import time
+import argparse
+import numpy as np
+from textimages import renderers, lores_array_from_hires
+
+
+def padded_diff(arr1, arr2):
+    """Absolute pixel differences of two arrays padded to the same size"""
+
+    rows = max(arr1.shape[0], arr2.shape[0])
+    cols = max(arr1.shape[1], arr2.shape[1])
+    pad1 = np.full((rows, cols), 255, dtype=np.int16)
+    pad1[:arr1.shape[0], :arr1.shape[1]] = arr1
+    pad2 = np.full((rows, cols), 255, dtype=np.int16)
+    pad2[:arr2.shape[0], :arr2.shape[1]] = arr2
+    return np.abs(pad1 - pad2)
+
+
+def diff_summary(diffs):
+    """Summarise a list of absolute difference arrays as a string"""
+
+    allpixels = sum(d.size for d in diffs)
+    return ('mean abs diff %.2f, pixels differing by >64: %.2f%%, '
+            'max diff %d' %
+            (sum(d.sum() for d in diffs) / allpixels,
+             100 * sum((d > 64).sum() for d in diffs) / allpixels,
+             max(d.max() for d in diffs)))
+
+
+arg_parser = argparse.ArgumentParser(
+    description='Compare the speed and output of the LuaLaTeX and '
+                'FreeType renderers')
+
+arg_parser.add_argument('txt', metavar='TEXTFILE',
+                        help='File containing text lines to render')
+arg_parser.add_argument('--fonts', metavar='FONTS',
+                        help='Fonts to use, comma-separated list '
+                        '(spaces can be replaced by underscores); '
+                        'will cycle through them, one per line',
+                        default='Times New Roman')
+arg_parser.add_argument('--fontsizes', metavar='SIZES',
+                        help='Fontsize, comma-separated list; will cycle '
+                        'through them for each font, one per line',
+                        default='10')
+arg_parser.add_argument('--rotation', metavar='ANGLE', type=float,
+                        help='Rotation to apply to every line', default=0)
+arg_parser.add_argument('--hires', metavar='RES', type=int,
+                        help='Rendering resolution (default 300)',
+                        default=300)
+arg_parser.add_argument('-r', '--resolution', metavar='RES', type=int,
+                        help='Low resolution to compare at (default 60)',
+                        default=60)
+arg_parser.add_argument('-n', '--lines', metavar='N', type=int,
+                        help='Maximum number of lines to render')
+
+args = arg_parser.parse_args()
+
+fonts = args.fonts.replace('_', ' ').split(',')
+sizes = list(map(float, args.fontsizes.split(',')))
+jobs = []
+with open(args.txt) as f:
+    for line in f:
+        line = line.strip()
+        if line == '':
+            continue
+        jobs.append((line, fonts[len(jobs) // len(sizes) % len(fonts)],
+                     sizes[len(jobs) % len(sizes)]))
+        if args.lines is not None and len(jobs) >= args.lines:
+            break
+
+ims = {}
+for name in ['lualatex', 'freetype']:
+    render = renderers[name]
+    start = time.perf_counter()
+    ims[name] = [render(text, font, fontsize=size, rotation=args.rotation,
+                        res=args.hires)
+                 for (text, font, size) in jobs]
+    elapsed = time.perf_counter() - start
+    print('%s: %d lines in %.2fs, %.2f lines/sec' %
+          (name, len(jobs), elapsed, len(jobs) / elapsed))
+
+scale = args.hires // args.resolution
+hidiffs = []
+lodiffs = []
+sizediffs = []
+for (imlua, imft) in zip(ims['lualatex'], ims['freetype']):
+    arrlua = np.asarray(imlua, dtype=np.uint8)
+    arrft = np.asarray(imft, dtype=np.uint8)
+    hidiffs.append(padded_diff(arrlua, arrft))
+    sizediffs.append((arrft.shape[1] - arrlua.shape[1],
+                      arrft.shape[0] - arrlua.shape[0]))
+    lowlua = lores_array_from_hires(arrlua, scale, border=2)
+    lowft = lores_array_from_hires(arrft, scale, border=2)
+    if lowlua is not None and lowft is not None:
+        lodiffs.append(padded_diff(lowlua, lowft))
+
+print('Mean size difference (freetype - lualatex) at %d dpi: '
+      'width %.1f, height %.1f pixels' %
+      (args.hires, np.mean([d[0] for d in sizediffs]),
+       np.mean([d[1] for d in sizediffs])))
+print('At %d dpi: %s' % (args.hires, diff_summary(hidiffs)))
+if lodiffs:
+    print('At %d dpi: %s' % (args.resolution, diff_summary(lodiffs)))
@@ -4,39 +4,143 @@
 """Fix a box file by merging the output of tesseract lstmbox and a
 box file with the correct character content but the wrong box size.
 
-Usage: $0 basename
+Usage: $0 basename [basename ...]
+       $0 --dir DIR | --glob PATTERN | --list FILE [--jobs N]
 
-This will then merge <basename>-lstm.box and <basename>.box and
-overwrite <basename>.box.
+For each basename, this will then merge <basename>-lstm.box and
+<basename>.box and overwrite <basename>.box.  With --dir, --glob or
+--list, every basename with a -lstm.box file in the directory, matching
+the pattern (for example 'linedata60/*/*-lstm.box') or listed in the
+file is fixed, all in one process, and a summary is printed at the end.
 """
 
+import os
 import sys
+import glob
+import tempfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 
-basename = sys.argv[1]
-boxdims = None
-
-with open(basename + '-lstm.box') as lstmbox:
-    for line in lstmbox:
-        fields = line.split()
-        boxdims = ' '.join(fields[-5:])
-        break
-
-# On rare occasions, tesseract can fail to make a meaningful
-# boxfile using lstmbox; the result is an empty box file.
-# We therefore do nothing more in that case.
-# (The frequency of this in the entire set of eng.training_text
-# across the 7 different types of enlargement tested was 348
-# out of 1355032.)
-if boxdims:
-    newbox = ''
+
+def fix_box(basename):
+    """Fix <basename>.box using <basename>-lstm.box
+
+    Returns True if the box file was fixed, or False if the lstmbox
+    file was empty, in which case the box file is left alone.
+    """
+
+    boxdims = None
+
+    with open(basename + '-lstm.box') as lstmbox:
+        for line in lstmbox:
+            fields = line.split()
+            boxdims = ' '.join(fields[-5:])
+            break
+
+    # On rare occasions, tesseract can fail to make a meaningful
+    # boxfile using lstmbox; the result is an empty box file.
+    # We therefore do nothing more in that case.
+    # (The frequency of this in the entire set of eng.training_text
+    # across the 7 different types of enlargement tested was 348
+    # out of 1355032.)
+    if not boxdims:
+        return False
+
+    newbox = []
     with open(basename + '.box') as box:
         for line in box:
             if line[0] == '\t':
-                newbox += '\t ' + boxdims + '\n'
+                newbox.append('\t ' + boxdims + '\n')
                 # this should be the final line, so we'll break here
                 break
             else:
-                newbox += line[0] + ' ' + boxdims + '\n'
+                # the character is everything before the five fields
+                # (which also keeps any combining characters)
+                newbox.append(line.rstrip('\n').rsplit(' ', 5)[0] + ' ' +
+                              boxdims + '\n')
+
+    # Write the new box file atomically, so that an interrupted run
+    # never leaves a truncated box file
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(basename) or '.',
+                                   suffix='.box.tmp')
+    try:
+        with os.fdopen(fd, 'w') as tmpbox:
+            print(''.join(newbox), end='', file=tmpbox)
+        os.chmod(tmppath, os.stat(basename + '.box').st_mode & 0o777)
+        os.replace(tmppath, basename + '.box')
+    except Exception:
+        os.remove(tmppath)
+        raise
+
+    return True
+
+
+def lstmbox_basenames(paths):
+    """The basenames for a list of -lstm.box file paths"""
+
+    return [p[:-len('-lstm.box')] for p in paths if p.endswith('-lstm.box')]
+
+
+arg_parser = argparse.ArgumentParser(
+    description='Fix box files using the output of tesseract lstmbox')
+
+arg_parser.add_argument('basenames', metavar='BASENAME', nargs='*',
+                        help='Fix BASENAME.box using BASENAME-lstm.box')
+arg_parser.add_argument('--dir', metavar='DIR', action='append',
+                        help='Fix every box file in DIR which has a '
+                             'corresponding -lstm.box file (may be '
+                             'repeated)')
+arg_parser.add_argument('--glob', metavar='PATTERN', action='append',
+                        help='Fix the box files for the -lstm.box files '
+                             'matching PATTERN (may be repeated)')
+arg_parser.add_argument('--list', metavar='FILE',
+                        help='Fix the box files for the basenames listed '
+                             'in FILE, one per line')
+arg_parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        help='Number of processes to use (default 1)',
+                        default=1)
+arg_parser.add_argument('--failures', metavar='FILE',
+                        help='Write the basenames whose lstmbox files were '
+                             'empty to FILE')
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+
+    basenames = list(args.basenames)
+    for d in args.dir or []:
+        basenames += lstmbox_basenames(
+            sorted(glob.glob(os.path.join(glob.escape(d), '*-lstm.box'))))
+    for pattern in args.glob or []:
+        basenames += lstmbox_basenames(sorted(glob.glob(pattern)))
+    if args.list:
+        with open(args.list) as f:
+            basenames += [line.strip() for line in f if line.strip()]
+
+    batch = args.dir or args.glob or args.list or len(basenames) > 1
+    if not basenames:
+        if not batch:
+            arg_parser.error('no basenames given')
+        print('No -lstm.box files found', file=sys.stderr)
+        sys.exit(0)
+
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            fixed = list(executor.map(fix_box, basenames, chunksize=256))
+    else:
+        fixed = list(map(fix_box, basenames))
 
-    with open(basename + '.box', 'w') as box:
-        print(newbox, end='', file=box)
+    failures = [b for b, ok in zip(basenames, fixed) if not ok]
+    if args.failures:
+        with open(args.failures, 'w') as f:
+            for b in failures:
+                print(b, file=f)
+    if batch:
+        print('Fixed %d of %d box files; %d empty lstmbox files' %
+              (len(basenames) - len(failures), len(basenames),
+               len(failures)), file=sys.stderr)
+        if failures and not args.failures:
+            for b in failures:
+                print('  empty: %s-lstm.box' % b, file=sys.stderr)
+    elif failures:
+        print('Empty lstmbox file %s-lstm.box; box file not fixed' %
+              failures[0], file=sys.stderr)
@@ -5,19 +5,46 @@
 
 The box files are not correct: they are the full size of the image, not
 the size of the text within it.  Fixing this requires a tesseract run
-with lstmbox, then running fix_lstm_box.py on it.
+with lstmbox, then running fix_lstm_box.py on it, for each scaling and
+blur that the images are to be used with (the Makefile does this).
+
+Each completed input line is recorded in the output directory's
+manifest (see manifest.py), which is used to resume with --cont.
+
+With --shard-size, the files are written into indexed tar shards (see
+shards.py) instead of as loose files.
+
+The low resolution tesseract does the scaling and blurring of each
+training variant (SCALING and BLUR in the Makefile) itself, so the
+images and ground truths are the same for all of the variants; only
+the box files are fixed separately for each one.  With --variant-outdir,
+the files are also put into each variant's training directory as they
+are made, as hard links where possible, with a copy of each box file.
+This works with --shard-size too, the variant directories getting loose
+files.
 """
 
 # loosly based on ocrd-train/generate_line_box.py
 # now https://github.com/tesseract-ocr/tesstrain
 import argparse
+import io
 import unicodedata
 import random
 import os
 import os.path
 import glob
 import re
-from textimages import hires_from_text, hires_to_lores
+import functools
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from textimages import (renderers, hires_from_text_batch,
+                        hires_to_lores, lores_variants)
+from rendercache import HiresCache
+from manifest import last_record, read_manifest, open_manifest, \
+    append_record, manifest_path
+from shards import ShardWriter
 
 
 arg_parser = argparse.ArgumentParser(
@@ -71,119 +98,428 @@ arg_parser.add_argument('--noise', metavar='NOISE', type=int,
                         help='amount of Gaussian noise to add',
                         default=3)
 
+arg_parser.add_argument('--variants', metavar='N', type=int,
+                        help='number of low resolution variants (random '
+                             'offsets and noise) to generate from each '
+                             'line; each is given its own line number',
+                        default=1)
+
+arg_parser.add_argument('--renderer', choices=sorted(renderers),
+                        help='How to render the high resolution images: '
+                             'with LuaLaTeX (the default) or with FreeType '
+                             'within this process (faster, but the '
+                             'results are slightly different)',
+                        default='lualatex')
+
+arg_parser.add_argument('--batch-size', metavar='N', type=int,
+                        help='number of lines to render with each run of '
+                             'lualatex (default 1); the lines are grouped '
+                             'by font and size',
+                        default=1)
+
+arg_parser.add_argument('--threads', metavar='N', type=int,
+                        help='number of threads to use to render each '
+                             'batch of lines (use with --batch-size; '
+                             'default 1)',
+                        default=1)
+
+arg_parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        help='number of processes to use (default 1); the '
+                             'output does not depend on this',
+                        default=1)
+
+arg_parser.add_argument('--cache', metavar='DIR',
+                        help='Directory in which to cache high resolution '
+                             'renderings of lines, so that they do not need '
+                             'to be rendered again on later runs')
+
+arg_parser.add_argument('--cache-size', metavar='MB', type=int,
+                        help='Maximum size of the rendering cache in MB '
+                             '(default 10000)',
+                        default=10000)
+
+arg_parser.add_argument('--shard-size', metavar='N', type=int,
+                        help='Write the files into tar shards of N line '
+                             'images each, named after the basename, '
+                             'rather than as separate files (default 0: '
+                             'separate files)',
+                        default=0)
+
+arg_parser.add_argument('--variant-outdir', metavar='DIR', action='append',
+                        help='Also put the files into DIR, such as the '
+                             'training directory of one scaling and blur '
+                             '(may be repeated); the box files are copied '
+                             'and the other files hard linked if possible',
+                        default=[])
+
 arg_parser.add_argument('--seed', metavar='SEED',
                         help='random seed to use')
 
 arg_parser.add_argument('-c', '--cont', action='store_true',
-                        help='Add images to existing directory')
+                        help='Add images to existing directory; if the '
+                             'same text file was being processed, resume '
+                             'after the last completed line')
 
 arg_parser.add_argument('-d', '--debug', action='store_true',
                         help='Run in debug mode')
 
-args = arg_parser.parse_args()
 
-if args.seed is not None:
-    random.seed(args.seed)
-else:
-    random.seed(args.txt)
-downscale = 300 // args.resolution
-upscale = 300 // args.resolution
+def line_files(line, lores, upscale):
+    """Make the image, ground truth and box files for one line image
 
-txtbase = os.path.basename(args.txt)
-if args.outbase is None:
-    outbase = os.path.splitext(txtbase)[0]
-else:
-    outbase = args.outbase
+    The box file has the box of every character set to the full size
+    of the image scaled up by upscale; see the comments at the top of
+    this file.  Returns a dict mapping each file extension to the
+    contents of the file as bytes.
+    """
 
-if args.cont:
-    boxes = glob.glob(os.path.join(args.outdir, outbase + '*.box'))
-    numre = re.compile(r'.*_(\d+)\.box')
-    linenum = 0
-    for b in boxes:
-        bmatch = numre.search(b)
-        if bmatch:
-            ln = int(bmatch.group(1))
-            if ln > linenum:
-                linenum = ln
-else:
-    linenum = 0
+    width, height = lores.size
+    hiwidth = upscale * width
+    hiheight = upscale * height
+    boxtxt = ''
+
+    for i in range(1, len(line)):
+        char = line[i]
+        prev_char = line[i-1]
+        if unicodedata.combining(char):
+            boxtxt += '%s %d %d %d %d 0\n' % \
+                        ((prev_char + char), 0, 0, hiwidth, hiheight)
+        elif not unicodedata.combining(prev_char):
+            boxtxt += '%s %d %d %d %d 0\n' % \
+                        (prev_char, 0, 0, hiwidth, hiheight)
+    if not unicodedata.combining(line[-1]):
+        boxtxt += '%s %d %d %d %d 0\n' % \
+                    (line[-1], 0, 0, hiwidth, hiheight)
+    boxtxt += ('%s %d %d %d %d 0' %
+               ("\t", hiwidth, hiheight, hiwidth + 1, hiheight + 1))
+
+    png = io.BytesIO()
+    lores.save(png, format='PNG', compression=None)
+    return {'.png': png.getvalue(),
+            '.gt.txt': (line + '\n').encode('utf-8'),
+            '.box': (boxtxt + '\n').encode('utf-8')}
+
+
+def write_line_files(outpath, files):
+    """Write the files made by line_files as outpath + extension"""
+
+    for ext, data in files.items():
+        with open(outpath + ext, 'wb') as f:
+            f.write(data)
+
+
+def write_variant_files(outpaths, files, linkpath=None):
+    """Write the files made by line_files as each of outpaths + extension
+
+    The box files are always written separately, as they are fixed
+    separately for each variant.  The other files are hard links to
+    linkpath + extension, if that has been written, or else to the
+    files for the first of outpaths; they are copies if hard links
+    cannot be made.
+    """
+
+    for outpath in outpaths:
+        for ext, data in files.items():
+            path = outpath + ext
+            # never write through an existing link from an earlier run
+            if os.path.lexists(path):
+                os.remove(path)
+            if ext != '.box' and linkpath is not None:
+                try:
+                    os.link(linkpath + ext, path)
+                    continue
+                except OSError:
+                    pass
+            with open(path, 'wb') as f:
+                f.write(data)
+        if linkpath is None:
+            linkpath = outpath
+
+
+def line_random(seed, lineno):
+    """The random number generators to use for a given input line
+
+    These depend only on the seed and the line number, so that the
+    output does not depend on the order in which lines are processed.
+    Returns a random.Random and an np.random.RandomState.
+    """
+
+    rng = random.Random('%s:%d' % (seed, lineno))
+    nprandom = np.random.RandomState(rng.randrange(2 ** 32))
+    return (rng, nprandom)
+
+
+def init_worker(worker_args):
+    """Set up the rendering for this process
+
+    This is called in each worker process (and in the main process if
+    we are not using workers).
+    """
+
+    global args, seed, fonts, downscale, render, render_batch
 
-fonts = args.fonts.replace('_', ' ').split(',')
-fonts_nospace = list(map(lambda f: f.replace(' ', '_'), fonts))
-sizes = list(map(float, args.fontsizes.split(',')))
-if not args.rotations or args.rotations == 'false':
-    rotations = [False]
-elif args.rotations.lower() == 'true':
-    rotations = [True]
-else:
-    rotations = [False, True]
-fontnum = 0
-sizenum = 0
-rotnum = 0
-
-with open(args.txt) as f:
-    for line in f:
-        line = line.strip()
-        if rotations[rotnum]:
-            rotation = random.gauss(0, 0.5)
+    args = worker_args
+    if args.seed is not None:
+        seed = args.seed
+    else:
+        seed = args.txt
+    fonts = args.fonts.replace('_', ' ').split(',')
+    downscale = 300 // args.resolution
+
+    if args.cache:
+        cache = HiresCache(args.cache, maxsize=args.cache_size * 1024 ** 2,
+                           renderer=args.renderer)
+        render = cache.hires_from_text
+        render_batch = functools.partial(cache.hires_from_text_batch,
+                                         workers=args.threads)
+    else:
+        render = renderers[args.renderer]
+        render_batch = functools.partial(hires_from_text_batch,
+                                         renderer=args.renderer,
+                                         workers=args.threads)
+
+
+def process_chunk(chunk):
+    """Render and scale down a chunk of lines
+
+    The chunk is a list of (lineno, line, fontnum, size, rotate)
+    tuples, where rotate says whether to apply a random rotation.
+    All of the random numbers for a line come from line_random.
+
+    Returns a list of (lineno, line, fontnum, size, rotation, lowarrays)
+    tuples, where lowarrays is a list of the low resolution images of
+    the line as uint8 arrays (or None where the image was entirely
+    white); this is empty if the line is empty.
+    """
+
+    jobs = []
+    for (lineno, line, fontnum, size, rotate) in chunk:
+        (rng, nprandom) = line_random(seed, lineno)
+        if rotate:
+            rotation = rng.gauss(0, 0.5)
         else:
             rotation = 0
-        print('Processing %s line %d; font = %s, size = %s, rotation %f' %
-              (txtbase, linenum + 1, fonts[fontnum], sizes[sizenum], rotation))
+        jobs.append((lineno, line, fontnum, size, rotation, rng, nprandom))
+
+    if args.batch_size == 1:
+        hireses = [render(line, fonts[fontnum], fontsize=size,
+                          rotation=rotation, res=300, debug=args.debug)
+                   for (lineno, line, fontnum, size, rotation, rng, nprandom)
+                   in jobs]
+    else:
+        hireses = render_batch(
+            [(line, fonts[fontnum], size, rotation)
+             for (lineno, line, fontnum, size, rotation, rng, nprandom)
+             in jobs],
+            res=300, debug=args.debug)
 
-        hires = hires_from_text(line, fonts[fontnum],
-                                fontsize=sizes[sizenum],
-                                rotation=rotation, res=300,
-                                debug=args.debug)
+    results = []
+    for (lineno, line, fontnum, size, rotation, rng, nprandom), hires in \
+            zip(jobs, hireses):
         if not hires:
-            continue
-        lores = hires_to_lores(hires, downscale, binary=args.binary,
-                               exposure=args.exposure,
-                               threshold=args.threshold,
-                               noise=args.noise, border=2)
-        if not lores:
-            # the image was entirely white
-            continue
-        linenum += 1
-
-        width, height = lores.size
-        hiwidth = upscale * width
-        hiheight = upscale * height
-        boxtxt = ''
-
-        for i in range(1, len(line)):
-            char = line[i]
-            prev_char = line[i-1]
-            if unicodedata.combining(char):
-                boxtxt += '%s %d %d %d %d 0\n' % \
-                            ((prev_char + char), 0, 0, hiwidth, hiheight)
-            elif not unicodedata.combining(prev_char):
-                boxtxt += '%s %d %d %d %d 0\n' % \
-                            (prev_char, 0, 0, hiwidth, hiheight)
-        if not unicodedata.combining(line[-1]):
-            boxtxt += '%s %d %d %d %d 0\n' % \
-                        (line[-1], 0, 0, hiwidth, hiheight)
-        boxtxt += ('%s %d %d %d %d 0' %
-                   ("\t", hiwidth, hiheight, hiwidth + 1, hiheight + 1))
-
-        outname = outbase + '_' + fonts_nospace[fontnum] + '_%03d' % linenum
-        lores.save(os.path.join(args.outdir, outname + '.png'),
-                   compression=None)
-        with open(os.path.join(args.outdir, outname + '.gt.txt'), "w") as gt:
-            print(line, file=gt)
-        with open(os.path.join(args.outdir, outname + '.box'), "w") as box:
-            print(boxtxt, file=box)
-
-        # cycle through the options
-        if rotnum < len(rotations) - 1:
-            rotnum += 1
+            lowarrays = []
+        elif args.variants == 1:
+            lores = hires_to_lores(hires, downscale, binary=args.binary,
+                                   exposure=args.exposure,
+                                   threshold=args.threshold,
+                                   noise=args.noise, border=2,
+                                   rng=rng, nprandom=nprandom)
+            lowarrays = [None if lores is None else np.asarray(lores)]
+        else:
+            variants = [{'offset': (rng.randint(0, downscale - 1),
+                                    rng.randint(0, downscale - 1)),
+                         'exposure': args.exposure,
+                         'threshold': args.threshold,
+                         'noise': args.noise}
+                        for v in range(args.variants)]
+            lowarrays = [lowarray for (variant, lowarray)
+                         in lores_variants(np.asarray(hires), downscale,
+                                           variants, binary=args.binary,
+                                           border=2, nprandom=nprandom)]
+        results.append((lineno, line, fontnum, size, rotation, lowarrays))
+
+    return results
+
+
+def map_in_order(executor, fn, items, window):
+    """Like executor.map(fn, items), but with at most window calls queued
+
+    executor.map submits every item at once, so with a long input file
+    the queued chunks (and their results, which are only collected in
+    order) could take a lot of memory.  This keeps no more than window
+    futures in flight, yielding the results in order as they finish.
+    """
+
+    futures = collections.deque()
+    for item in items:
+        if len(futures) >= window:
+            yield futures.popleft().result()
+        futures.append(executor.submit(fn, item))
+    while futures:
+        yield futures.popleft().result()
+
+
+def read_chunks(txt, batch_size, nfonts, sizes, rotations, skip=0):
+    """Read the input text file in chunks of batch_size lines
+
+    This generates the chunks to pass to process_chunk, cycling through
+    the rotations, then the sizes, then the nfonts fonts, one non-empty
+    line at a time.  The first skip lines are left out of the chunks
+    (but still count towards the cycling).
+    """
+
+    fontnum = 0
+    sizenum = 0
+    rotnum = 0
+    lineno = 0
+
+    with open(txt) as f:
+        while True:
+            chunk = []
+            while len(chunk) < batch_size:
+                line = f.readline()
+                if line == '':
+                    break
+                lineno += 1
+                line = line.strip()
+                if lineno > skip:
+                    chunk.append((lineno, line, fontnum, sizes[sizenum],
+                                  rotations[rotnum]))
+                if line == '':
+                    continue
+
+                # cycle through the options
+                if rotnum < len(rotations) - 1:
+                    rotnum += 1
+                else:
+                    rotnum = 0
+                    if sizenum < len(sizes) - 1:
+                        sizenum += 1
+                    else:
+                        sizenum = 0
+                        if fontnum < nfonts - 1:
+                            fontnum += 1
+                        else:
+                            fontnum = 0
+            if not chunk:
+                break
+            yield chunk
+
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+    init_worker(args)
+
+    upscale = 300 // args.resolution
+
+    txtbase = os.path.basename(args.txt)
+    if args.outbase is None:
+        outbase = os.path.splitext(txtbase)[0]
+    else:
+        outbase = args.outbase
+
+    linenum = 0
+    skip = 0
+    if args.cont:
+        record = last_record(args.outdir)
+        if record is None:
+            # An old directory without a manifest
+            boxes = glob.glob(os.path.join(args.outdir, outbase + '*.box'))
+            numre = re.compile(r'.*_(\d+)\.box')
+            for b in boxes:
+                bmatch = numre.search(b)
+                if bmatch:
+                    ln = int(bmatch.group(1))
+                    if ln > linenum:
+                        linenum = ln
+        elif record['outbase'] == outbase:
+            linenum = record['linenum']
+            if record['txt'] == txtbase:
+                # Resume after the last completed line; any files
+                # written for later lines will be overwritten
+                skip = record['lineno']
         else:
-            rotnum = 0
-            if sizenum < len(sizes) - 1:
-                sizenum += 1
-            else:
-                sizenum = 0
-                if fontnum < len(fonts) - 1:
-                    fontnum += 1
+            for record in read_manifest(args.outdir):
+                if record['outbase'] == outbase:
+                    linenum = record['linenum']
+    elif os.path.isfile(manifest_path(args.outdir)):
+        os.remove(manifest_path(args.outdir))
+    manifest = open_manifest(args.outdir)
+
+    for variantdir in args.variant_outdir:
+        os.makedirs(variantdir, exist_ok=True)
+
+    if args.shard_size > 0:
+        # Resumed runs always start a new shard, as the last one may
+        # have been left incomplete
+        shards = ShardWriter(args.outdir, outbase, args.shard_size,
+                             ShardWriter.next_shard(args.outdir, outbase))
+    else:
+        shards = None
+
+    fonts_nospace = list(map(lambda f: f.replace(' ', '_'), fonts))
+    sizes = list(map(float, args.fontsizes.split(',')))
+    if not args.rotations or args.rotations == 'false':
+        rotations = [False]
+    elif args.rotations.lower() == 'true':
+        rotations = [True]
+    else:
+        rotations = [False, True]
+
+    chunks = read_chunks(args.txt, args.batch_size, len(fonts), sizes,
+                         rotations, skip=skip)
+    if args.jobs > 1:
+        executor = ProcessPoolExecutor(max_workers=args.jobs,
+                                       initializer=init_worker,
+                                       initargs=(args,))
+        results = map_in_order(executor, process_chunk, chunks,
+                               2 * args.jobs)
+    else:
+        executor = None
+        results = map(process_chunk, chunks)
+
+    # The results come back in order, so the output files are the
+    # same whatever the number of jobs
+    for chunkresults in results:
+        for (lineno, line, fontnum, size, rotation,
+             lowarrays) in chunkresults:
+            print('Processing %s line %d; font = %s, size = %s, '
+                  'rotation %f' %
+                  (txtbase, linenum + 1, fonts[fontnum], size, rotation))
+            linenums = []
+            outputs = []
+            shardnames = []
+            for lowarray in lowarrays:
+                if lowarray is None:
+                    # the image was entirely white
+                    continue
+                linenum += 1
+                outname = (outbase + '_' + fonts_nospace[fontnum] +
+                           '_%03d' % linenum)
+                files = line_files(line, Image.fromarray(lowarray), upscale)
+                if shards is None:
+                    outpath = os.path.join(args.outdir, outname)
+                    write_line_files(outpath, files)
                 else:
-                    fontnum = 0
+                    outpath = None
+                    shardnames.append(shards.add(outname, files))
+                write_variant_files([os.path.join(variantdir, outname)
+                                     for variantdir in args.variant_outdir],
+                                    files, linkpath=outpath)
+                linenums.append(linenum)
+                outputs.append(outname)
+
+            record = {'txt': txtbase, 'lineno': lineno,
+                      'outbase': outbase, 'line': line,
+                      'font': fonts[fontnum], 'size': size,
+                      'rotation': rotation, 'linenums': linenums,
+                      'outputs': outputs, 'linenum': linenum}
+            if shards is not None:
+                record['shards'] = shardnames
+            append_record(manifest, record)
+
+    manifest.close()
+    if shards is not None:
+        shards.close()
+    if executor is not None:
+        executor.shutdown()
@@ -5,6 +5,8 @@ import re
 import difflib
 import editdistance
 import csv
+import numpy as np
+from ocrpage import OCRPage
 
 
 def get_metrics(pagetxt, gt, filename):
@@ -96,6 +98,10 @@ def compute_hocr_diff(hocrpage, gt):
     are ignored.
     """
 
+    if isinstance(hocrpage, OCRPage):
+        compute_ocr_page_diff(hocrpage, gt)
+        return
+
     pagetext = []
     pagerefs = []
 
@@ -124,6 +130,25 @@ def compute_hocr_diff(hocrpage, gt):
             print('Unknown tag: %s' % tag)
 
 
+def compute_ocr_page_diff(page, gt):
+    """Compute whether each word of an OCRPage is correct or not
+
+    This is the same as compute_hocr_diff, but records the results in
+    the page's correct array.
+    """
+
+    qtrans = str.maketrans('“”‘’—–', '""' + "''--")
+    gttext = gt.translate(qtrans).split()
+
+    page.correct = np.zeros(page.nwords, dtype=bool)
+    s = difflib.SequenceMatcher(None, page.word_strings(), gttext)
+    for tag, i1, i2, j1, j2 in s.get_opcodes():
+        if tag == 'equal':
+            page.correct[i1:i2] = True
+        elif tag not in ('replace', 'delete', 'insert'):
+            print('Unknown tag: %s' % tag)
+
+
 def output_hocr_diff_metrics(hocrpage, csvfile):
     """Output word-level metrics on the accuracy of hOCR output
 
@@ -137,12 +162,17 @@ def output_hocr_diff_metrics(hocrpage, csvfile):
     """
 
     headrow = ['Word', 'Confidence', 'Correct']
-    outrows = []
-    for a in hocrpage['areas']:
-        for p in a['pars']:
-            for ln in p['lines']:
-                for w in ln['words']:
-                    outrows.append([w['word'], w['conf'], w['correct']])
+    if isinstance(hocrpage, OCRPage):
+        outrows = [list(row) for row in
+                   zip(hocrpage.word_strings(), hocrpage.conf.tolist(),
+                       hocrpage.correct.tolist())]
+    else:
+        outrows = []
+        for a in hocrpage['areas']:
+            for p in a['pars']:
+                for ln in p['lines']:
+                    for w in ln['words']:
+                        outrows.append([w['word'], w['conf'], w['correct']])
 
     with open(csvfile, 'w') as outfile:
         outwriter = csv.writer(outfile)
@@ -255,7 +255,7 @@ def process_file(fn, hocr=None, debug=False, bbox='area,par,line'):
     else:
         hocr = imgbase + '.hocr'
         hocrbase = imgbase
-    page, tidied = parse_hocr.parse_hocr_file(hocr)
+    tidied = parse_hocr.read_hocr_file(hocr)
 
     try:
         img_orig = Image.open(imgfn)
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Make the .lstmf training files for many line images at once
+
+The Makefile's %.lstmf rule runs the low resolution tesseract once for
+every line image, reloading eng.traineddata each time.  This instead
+gives tesseract a list file of many images at a time, which produces a
+single .lstmf file containing one page for each image; we then split
+that back into a .lstmf file for each image, with the page number set
+to 0, just as the per-image rule would have made it.  The batches are
+run by a pool of worker threads (each running a single-threaded
+tesseract).
+
+With a list file, tesseract treats the Nth image (counting from 0) as
+page N, and only uses the lines of its box file whose page field is N,
+whereas the box files of the line images all have page 0.  So each
+batch is run on a temporary directory holding a link to each image and
+a copy of its box file with the page field set to the image's position
+in the batch; the image file names in the pages are then set back to
+those of the original images.
+
+An .lstmf file is a serialised tesseract DocumentData: a 32-bit count
+of pages, then for each page a one byte "not null" flag followed by the
+serialised ImageData, which consists of:
+
+    imagefilename (string), page_number (int32), image (char vector),
+    language (string), transcription (string), boxes (TBOX vector),
+    box_texts (vector of strings), vertical_text (int8)
+
+where strings and vectors are a 32-bit length followed by the data,
+and a TBOX is four 16-bit integers.  (Everything is little-endian.)
+The pages are matched to the images by their image file names if
+tesseract recorded them, otherwise by their page numbers, otherwise by
+their order; if a batch fails or its pages cannot be matched to its
+images, the images are retried, and then processed one at a time.
+
+The result for every image (whether it succeeded, how many attempts it
+took and any error) can be written to a JSON lines file, and the
+throughput in images per second is reported at the end.  With
+--per-image, each image is processed with its own tesseract run, as the
+Makefile rule does, for comparison.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import struct
+import tempfile
+import argparse
+import functools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+def skip_vector(data, pos, itemsize):
+    """Skip over a serialised vector (or string) starting at pos"""
+
+    (size,) = struct.unpack_from('<i', data, pos)
+    if size < 0:
+        raise ValueError('negative vector size at %d' % pos)
+    end = pos + 4 + size * itemsize
+    if end > len(data):
+        raise ValueError('vector at %d runs past end of data' % pos)
+    return end
+
+
+def read_string(data, pos):
+    """Read a serialised string at pos, returning it and the next pos"""
+
+    end = skip_vector(data, pos, 1)
+    return (data[pos + 4:end].decode('utf-8', errors='replace'), end)
+
+
+def split_lstmf(data):
+    """Split the contents of an .lstmf file into its pages
+
+    Returns a list of (imagefilename, page_number, pagedata) tuples,
+    where pagedata is the serialised page including its "not null"
+    flag; null pages are omitted.
+    """
+
+    (count,) = struct.unpack_from('<i', data, 0)
+    pos = 4
+    pages = []
+    for i in range(count):
+        start = pos
+        notnull = data[pos]
+        pos += 1
+        if not notnull:
+            continue
+        (imagefilename, pos) = read_string(data, pos)
+        (page_number,) = struct.unpack_from('<i', data, pos)
+        pos += 4
+        pos = skip_vector(data, pos, 1)  # image
+        pos = skip_vector(data, pos, 1)  # language
+        pos = skip_vector(data, pos, 1)  # transcription
+        pos = skip_vector(data, pos, 8)  # boxes
+        (ntexts,) = struct.unpack_from('<i', data, pos)
+        pos += 4
+        for j in range(ntexts):
+            pos = skip_vector(data, pos, 1)
+        pos += 1  # vertical_text
+        if pos > len(data):
+            raise ValueError('page %d runs past end of data' % i)
+        pages.append((imagefilename, page_number, data[start:pos]))
+
+    if pos != len(data):
+        raise ValueError('unexpected data after the last page')
+    return pages
+
+
+def set_page(pagedata, imagefilename, page_number):
+    """Change the image file name and page number of a serialised page"""
+
+    (namelen,) = struct.unpack_from('<i', pagedata, 1)
+    pos = 5 + namelen
+    name = imagefilename.encode('utf-8')
+    return (pagedata[:1] + struct.pack('<i', len(name)) + name +
+            struct.pack('<i', page_number) + pagedata[pos + 4:])
+
+
+def batch_box(boxpath, page_number):
+    """The contents of a box file with every page field set to page_number
+
+    Each line of a box file is the character (which may be a space or
+    tab) followed by the left, bottom, right, top and page fields.
+    Raises OSError if the box file cannot be read, or ValueError if it
+    is not UTF-8.
+    """
+
+    with open(boxpath, encoding='utf-8') as box:
+        lines = box.read().split('\n')
+    return ''.join(line.rsplit(' ', 1)[0] + ' %d\n' % page_number
+                   for line in lines if line)
+
+
+def join_lstmf(pagedatas):
+    """Make the contents of an .lstmf file from serialised pages"""
+
+    return struct.pack('<i', len(pagedatas)) + b''.join(pagedatas)
+
+
+def match_pages(pages, images):
+    """Match the pages of a batch .lstmf to the images in the batch
+
+    Returns a dict mapping each image to its list of serialised pages,
+    or None if the pages cannot be matched.
+    """
+
+    matched = {image: [] for image in images}
+    if pages and all(name in matched for (name, num, data) in pages):
+        for (name, num, data) in pages:
+            matched[name].append(data)
+    elif pages and all(0 <= num < len(images) for (name, num, data) in pages):
+        if len(set(num for (name, num, data) in pages)) < len(pages):
+            return None
+        for (name, num, data) in pages:
+            matched[images[num]].append(data)
+    elif len(pages) == len(images):
+        for (image, (name, num, data)) in zip(images, pages):
+            matched[image].append(data)
+    else:
+        return None
+    return matched
+
+
+def write_atomic(path, data):
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                   suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmppath, 0o644)
+        os.replace(tmppath, path)
+    except Exception:
+        os.remove(tmppath)
+        raise
+
+
+def tess_settings(tessbin='tesseract', lang='eng', resolution=60,
+                  scaling=2, blur='0', psm=6, timeout=None, retries=1,
+                  env=None):
+    """The settings for making .lstmf files, as a dict
+
+    These are passed to the functions below.  They are the same as the
+    command line options; env is the environment for tesseract (default
+    our own).
+    """
+
+    return {'tessbin': tessbin, 'lang': lang, 'resolution': resolution,
+            'scaling': scaling, 'blur': blur, 'psm': psm,
+            'timeout': timeout, 'retries': retries, 'env': env}
+
+
+def tesseract_cmd(inputpath, outbase, settings):
+    return [settings['tessbin'], '--dpi', '300', '-l', settings['lang'],
+            '-c', 'low_resolution_input=true',
+            '-c', 'low_resolution_dpi=%d' % settings['resolution'],
+            '-c', 'low_resolution_scaling=%d' % settings['scaling'],
+            '-c', 'low_resolution_blurring=%s' % settings['blur'],
+            '--psm', str(settings['psm']), inputpath, outbase, 'lstm.train']
+
+
+def run_tesseract(inputpath, outbase, settings):
+    """Run tesseract, returning None if it succeeded or an error message"""
+
+    try:
+        result = subprocess.run(tesseract_cmd(inputpath, outbase, settings),
+                                capture_output=True, env=settings['env'],
+                                timeout=settings['timeout'])
+    except subprocess.TimeoutExpired:
+        return 'tesseract timed out'
+    if result.returncode != 0:
+        return ('tesseract failed with status %d: %s' %
+                (result.returncode,
+                 result.stderr.decode(errors='replace').strip()[-500:]))
+    return None
+
+
+def process_image(image, settings, attempts=0):
+    """Make the .lstmf file for a single image as the Makefile rule does
+
+    settings is made by tess_settings.  Returns the result for the image.
+    """
+
+    outbase = os.path.splitext(image)[0]
+    error = None
+    while attempts <= settings['retries']:
+        attempts += 1
+        if os.path.isfile(outbase + '.lstmf'):
+            os.remove(outbase + '.lstmf')
+        error = run_tesseract(image, outbase, settings)
+        if error is None:
+            if os.path.isfile(outbase + '.lstmf'):
+                return {'image': image, 'ok': True, 'attempts': attempts,
+                        'batched': False}
+            error = 'tesseract did not write %s.lstmf' % outbase
+    return {'image': image, 'ok': False, 'attempts': attempts,
+            'batched': False, 'error': error}
+
+
+def process_batch(images, settings):
+    """Make the .lstmf files for a batch of images
+
+    settings is made by tess_settings.  Returns a list of the results
+    for the images.
+    """
+
+    attempts = 0
+    matched = None
+    batch = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # tesseract reads the box file next to each image, so the links
+        # to the images are named by their page numbers
+        for image in images:
+            link = os.path.join(tmpdir, '%05d.png' % len(batch))
+            try:
+                boxtxt = batch_box(os.path.splitext(image)[0] + '.box',
+                                   len(batch))
+            except (OSError, ValueError):
+                # leave it to process_image to report the error
+                continue
+            os.symlink(os.path.abspath(image), link)
+            with open(link[:-4] + '.box', 'w', encoding='utf-8') as f:
+                f.write(boxtxt)
+            batch[image] = link
+        links = list(batch.values())
+        listpath = os.path.join(tmpdir, 'images.txt')
+        with open(listpath, 'w') as listfile:
+            for link in links:
+                print(link, file=listfile)
+
+        outbase = os.path.join(tmpdir, 'batch')
+        while (links and attempts <= settings['retries'] and
+               matched is None):
+            attempts += 1
+            if os.path.isfile(outbase + '.lstmf'):
+                os.remove(outbase + '.lstmf')
+            error = run_tesseract(listpath, outbase, settings)
+            if error is not None:
+                continue
+            try:
+                with open(outbase + '.lstmf', 'rb') as f:
+                    pages = split_lstmf(f.read())
+            except (OSError, ValueError, struct.error):
+                continue
+            matched = match_pages(pages, links)
+
+    if matched is None:
+        # Give up on batching this lot
+        return [process_image(image, settings,
+                              attempts=max(attempts - 1, 0))
+                for image in images]
+
+    results = []
+    for image in images:
+        if image in batch and matched[batch[image]]:
+            write_atomic(os.path.splitext(image)[0] + '.lstmf',
+                         join_lstmf([set_page(pagedata, image, 0)
+                                     for pagedata in matched[batch[image]]]))
+            results.append({'image': image, 'ok': True,
+                            'attempts': attempts, 'batched': True})
+        else:
+            # tesseract made no training data for this image in the
+            # batch (or it has no box file), so try it by itself to get
+            # its error
+            results.append(process_image(image, settings))
+    return results
+
+
+def process_one(batch, settings):
+    return [process_image(batch[0], settings)]
+
+
+def is_done(image):
+    """Whether the .lstmf file is newer than the image and box file"""
+
+    base = os.path.splitext(image)[0]
+    try:
+        return (os.path.getmtime(base + '.lstmf') >=
+                max(os.path.getmtime(image), os.path.getmtime(base + '.box')))
+    except OSError:
+        return False
+
+
+arg_parser = argparse.ArgumentParser(
+    description='Make .lstmf files for many line images with few '
+                'tesseract runs')
+
+arg_parser.add_argument('inputs', metavar='INPUT', nargs='+',
+                        help='Directories of line images (.png with .box '
+                             'files), glob patterns, or files listing '
+                             'image paths (ending .txt)')
+arg_parser.add_argument('-r', '--resolution', metavar='RES', type=int,
+                        help='Resolution of the images (default 60)',
+                        default=60)
+arg_parser.add_argument('--scaling', metavar='N', type=int,
+                        help='Scaling method (0=box, 1=bilinear, '
+                             '2=bicubic; default 2)',
+                        default=2)
+arg_parser.add_argument('--blur', metavar='SD',
+                        help='Gaussian blur (default 0)', default='0')
+arg_parser.add_argument('--psm', metavar='PSM', type=int,
+                        help='Page segmentation mode (default 6)', default=6)
+arg_parser.add_argument('-l', '--lang', metavar='LANG',
+                        help='Language (default eng)', default='eng')
+arg_parser.add_argument('--tessbin', metavar='PATH',
+                        help='The low resolution tesseract executable',
+                        default='tesseract')
+arg_parser.add_argument('-b', '--batch-size', metavar='N', type=int,
+                        help='Number of images per tesseract run '
+                             '(default 200)',
+                        default=200)
+arg_parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        help='Number of tesseract runs at a time '
+                             '(default 1)',
+                        default=1)
+arg_parser.add_argument('--retries', metavar='N', type=int,
+                        help='Number of times to retry a failed run '
+                             '(default 1)',
+                        default=1)
+arg_parser.add_argument('--timeout', metavar='SECS', type=float,
+                        help='Time limit for each tesseract run')
+arg_parser.add_argument('--per-image', action='store_true',
+                        help='Run tesseract once per image, as the '
+                             'Makefile rule does')
+arg_parser.add_argument('-f', '--force', action='store_true',
+                        help='Remake .lstmf files which are up to date')
+arg_parser.add_argument('--results', metavar='FILE',
+                        help='Write the result for each image to FILE as '
+                             'JSON lines')
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+
+    # Each tesseract is single-threaded, as we run several at once
+    tess_env = dict(os.environ)
+    if args.jobs > 1:
+        tess_env['OMP_THREAD_LIMIT'] = '1'
+    settings = tess_settings(tessbin=args.tessbin, lang=args.lang,
+                             resolution=args.resolution,
+                             scaling=args.scaling, blur=args.blur,
+                             psm=args.psm, timeout=args.timeout,
+                             retries=args.retries, env=tess_env)
+
+    images = []
+    for inp in args.inputs:
+        if os.path.isdir(inp):
+            images += sorted(glob.glob(os.path.join(glob.escape(inp),
+                                                    '*.png')))
+        elif inp.endswith('.txt') and os.path.isfile(inp):
+            with open(inp) as f:
+                images += [line.strip() for line in f if line.strip()]
+        else:
+            images += sorted(glob.glob(inp))
+    if not args.force:
+        images = [image for image in images if not is_done(image)]
+
+    start = time.perf_counter()
+    if args.per_image or args.batch_size <= 1:
+        batches = [[image] for image in images]
+        work = process_one
+    else:
+        batches = [images[i:i + args.batch_size]
+                   for i in range(0, len(images), args.batch_size)]
+        work = process_batch
+
+    results = []
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for batchresults in executor.map(
+                functools.partial(work, settings=settings), batches):
+            results += batchresults
+    elapsed = time.perf_counter() - start
+
+    if args.results:
+        with open(args.results, 'w') as f:
+            for result in results:
+                print(json.dumps(result), file=f)
+
+    failures = [result for result in results if not result['ok']]
+    for result in failures:
+        print('Failed: %s: %s' % (result['image'], result['error']),
+              file=sys.stderr)
+    print('Made %d of %d .lstmf files in %.1fs (%.2f images/sec)' %
+          (len(results) - len(failures), len(results), elapsed,
+           len(results) / elapsed if elapsed > 0 else 0),
+          file=sys.stderr)
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+An append-only manifest of the training lines generated in a directory
+
+gen_tess_training_data.py appends one JSON record per input line to
+manifest.jsonl in the output directory once all of the files for that
+line have been written.  Each record looks like:
+
+    {"txt": "eng.training_text_split_aaa", "lineno": 17,
+     "outbase": "aaa", "line": "the text of the line",
+     "font": "Times New Roman", "size": 10.0, "rotation": 0.31,
+     "linenums": [23], "outputs": ["aaa_Times_New_Roman_023"],
+     "linenum": 23}
+
+where lineno is the line number in the input text file, linenums are
+the line numbers given to the output images, outputs are their
+basenames (each has .png, .gt.txt and .box files) and linenum is the
+last output line number used so far for this outbase.  An empty input
+line has no outputs.  When the files are written to shards (see
+shards.py), there is also a "shards" list giving the shard containing
+each output.
+
+As the record is only written after the files, a line whose record is
+missing was not completed; if the process crashed while writing the
+record itself, the manifest ends in a partial line, which is ignored
+(and removed by open_manifest).  Finding where to resume only requires
+reading the end of the manifest.
+
+Other tools can use read_manifest to iterate over the generated lines.
+"""
+
+import os
+import json
+
+manifest_name = 'manifest.jsonl'
+
+
+def manifest_path(outdir):
+    return os.path.join(outdir, manifest_name)
+
+
+def read_manifest(outdir):
+    """Generate the complete records in the manifest, in order"""
+
+    path = manifest_path(outdir)
+    if not os.path.isfile(path):
+        return
+    with open(path, 'rb') as mf:
+        for rawline in mf:
+            if not rawline.endswith(b'\n'):
+                # a partial record left by a crash
+                break
+            yield json.loads(rawline)
+
+
+def last_record(outdir, blocksize=65536):
+    """Return the last complete record in the manifest, or None
+
+    This reads backwards from the end of the manifest, so takes the
+    same time however long the manifest is.
+    """
+
+    path = manifest_path(outdir)
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, 'rb') as mf:
+        end = mf.seek(0, os.SEEK_END)
+        pos = end
+        tail = b''
+        while pos > 0:
+            pos = max(pos - blocksize, 0)
+            mf.seek(pos)
+            tail = mf.read(end - pos)
+            # We need two newlines to be sure we have a whole record,
+            # unless we have reached the start of the file
+            if tail.count(b'\n') >= 2:
+                break
+
+    # Anything after the final newline is a partial record
+    lines = tail[:tail.rfind(b'\n') + 1].splitlines()
+    if pos > 0:
+        # the first line may be a fragment of a record
+        lines = lines[1:]
+    for rawline in reversed(lines):
+        if rawline.strip():
+            return json.loads(rawline)
+    return None
+
+
+def open_manifest(outdir):
+    """Open the manifest for appending
+
+    If the manifest ends with a partial record, this is removed first.
+    """
+
+    path = manifest_path(outdir)
+    if os.path.isfile(path):
+        with open(path, 'rb+') as mf:
+            end = mf.seek(0, os.SEEK_END)
+            pos = end
+            while pos > 0:
+                mf.seek(pos - 1)
+                if mf.read(1) == b'\n':
+                    break
+                pos -= 1
+            if pos < end:
+                mf.truncate(pos)
+
+    return open(path, 'a')
+
+
+def append_record(mf, record):
+    """Append a record to a manifest opened with open_manifest
+
+    The record is flushed immediately, so that it survives the process
+    being killed.
+    """
+
+    print(json.dumps(record, ensure_ascii=False), file=mf, flush=True)
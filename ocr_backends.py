@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Backends for running the low resolution tesseract on an image
+
+Each backend has a method
+
+    ocr(imgdir, image, outbase, config)
+
+which makes outbase.hocr and outbase.txt in the directory imgdir from
+the image file image (both names being relative to imgdir), just as
+running `tesseract image outbase txt hocr` in imgdir does.  config is a
+(tessdata, scaling, blur) tuple, where tessdata is the directory
+containing eng.traineddata for this scaling and blur, scaling is the
+low_resolution_scaling number (0=box, 1=bilinear, 2=bicubic) and blur is
+the low_resolution_blurring amount as a string.  ocr may be called from
+several threads at once.  A backend should be closed when it is no
+longer needed; they can be used as context managers.
+
+The backends are:
+
+    cli:  runs the tesseract command line program for every image, as
+          ocr_images.py always used to; this reloads the traineddata
+          model for every image and scaling.
+
+    pool: keeps tesseract worker processes running, each of which has
+          loaded the model for one configuration (using a ctypes
+          binding to the modified libtesseract), and sends the images
+          to them one at a time.  A worker is started for a
+          configuration when there is no idle worker for it; once there
+          are as many workers as allowed, an idle worker for another
+          configuration is stopped to make room.
+
+    stub: the pool backend, but with workers which return canned hOCR
+          rather than running tesseract, so that the pool, scheduling
+          and error handling can be tried out without the modified
+          tesseract.  The canned hOCR can be given in a file, and the
+          workers can be told to be slow, to fail on some images, or to
+          crash on some images (see stub_engine below).
+
+If a pool worker crashes or times out, it is stopped and the image is
+retried with a new worker (up to retries times); if tesseract reports
+an error for the image, OCRError is raised.
+
+This file is also the program run by each pool worker: it is given the
+configuration on the command line, and then reads requests as JSON
+lines {"cwd": ..., "image": ..., "outbase": ...} on its standard input,
+writing a JSON line {"ok": true} or {"ok": false, "error": ...} on its
+standard output for each one.  It writes one such line once it has
+loaded the model, before reading any requests.
+"""
+
+import sys
+import os
+import re
+import json
+import select
+import fnmatch
+import threading
+import subprocess
+import argparse
+import ctypes
+import ctypes.util
+import time
+
+
+class OCRError(Exception):
+    pass
+
+
+class Backend:
+    # Results from backends with different cache tags are cached
+    # separately (see ocrcache.py)
+    cache_tag = None
+
+    def ocr(self, imgdir, image, outbase, config):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def tess_variables(config, resolution):
+    """The -c variables for the low resolution tesseract"""
+
+    (tessdata, scaling, blur) = config
+    return [('low_resolution_input', 'true'),
+            ('low_resolution_dpi', '%d' % resolution),
+            ('low_resolution_scaling', '%d' % scaling),
+            ('low_resolution_blurring', blur)]
+
+
+class CliBackend(Backend):
+    def __init__(self, tessbin='tesseract', env=None, resolution=60,
+                 omp_threads=None, debug=False):
+        """Run tessbin for each image, with the environment env
+
+        omp_threads, if given, limits the OpenMP threads of each
+        tesseract run.
+        """
+
+        self.tessbin = tessbin
+        self.env = dict(os.environ) if env is None else env
+        self.resolution = resolution
+        self.omp_threads = omp_threads
+        self.debug = debug
+
+    def ocr(self, imgdir, image, outbase, config):
+        env = dict(self.env)
+        env['TESSDATA_PREFIX'] = config[0]
+        if self.omp_threads:
+            env['OMP_THREAD_LIMIT'] = str(self.omp_threads)
+        cmd = [self.tessbin, '--dpi', '300', '-l', 'eng']
+        for var, val in tess_variables(config, self.resolution):
+            cmd += ['-c', '%s=%s' % (var, val)]
+        cmd += ['--psm', '6', image, outbase, 'txt', 'hocr']
+        if self.debug:
+            print('About to run: %s' % ' '.join(cmd), file=sys.stderr)
+            print('TESSDATA_PREFIX = %s' % config[0])
+        subprocess.run(cmd, check=True, env=env, cwd=imgdir or None)
+
+
+class Worker:
+    def __init__(self, config, engine, engine_args, resolution, env,
+                 timeout):
+        """Start a worker process for config and wait until it is ready"""
+
+        cmd = [sys.executable, os.path.abspath(__file__),
+               '--engine', engine, '--resolution', str(resolution),
+               '--config', json.dumps(config)] + engine_args
+        self.config = config
+        self.timeout = timeout
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, env=env)
+        self.lastused = time.monotonic()
+        try:
+            reply = self.reply()
+        except OCRError:
+            self.stop()
+            raise
+        if not reply['ok']:
+            self.stop()
+            raise OCRError('cannot start tesseract worker for %s: %s' %
+                           (config[0], reply['error']))
+
+    def reply(self):
+        """Read the next reply from the worker
+
+        Raises OCRError if the worker has died or does not reply in
+        time.
+        """
+
+        if self.timeout:
+            ready, _, _ = select.select([self.proc.stdout], [], [],
+                                        self.timeout)
+            if not ready:
+                raise OCRError('tesseract worker timed out')
+        line = self.proc.stdout.readline()
+        if not line:
+            self.proc.wait()
+            raise OCRError('tesseract worker died with status %d' %
+                           self.proc.returncode)
+        return json.loads(line)
+
+    def ocr(self, imgdir, image, outbase):
+        request = {'cwd': os.path.abspath(imgdir or '.'), 'image': image,
+                   'outbase': outbase}
+        try:
+            self.proc.stdin.write(json.dumps(request).encode() + b'\n')
+            self.proc.stdin.flush()
+        except OSError:
+            raise OCRError('tesseract worker died')
+        self.lastused = time.monotonic()
+        return self.reply()
+
+    def stop(self):
+        self.proc.kill()
+        self.proc.wait()
+        for f in [self.proc.stdin, self.proc.stdout]:
+            try:
+                f.close()
+            except OSError:
+                pass
+
+
+class PoolBackend(Backend):
+    def __init__(self, workers=1, env=None, resolution=60,
+                 omp_threads=None, timeout=None, retries=1,
+                 libtesseract=None, debug=False):
+        """Keep up to workers tesseract worker processes running
+
+        env is the environment for the workers (and so for tesseract);
+        omp_threads, if given, limits the OpenMP threads of each worker.
+        timeout is the time limit in seconds for a worker to load its
+        model or to process an image, and a worker which crashes or
+        times out is replaced up to retries times for each image.
+        libtesseract is the path to the modified libtesseract (by
+        default it is searched for in the usual way).
+        """
+
+        self.workers = workers
+        self.env = dict(os.environ) if env is None else dict(env)
+        if omp_threads:
+            self.env['OMP_THREAD_LIMIT'] = str(omp_threads)
+        self.resolution = resolution
+        self.timeout = timeout
+        self.retries = retries
+        self.debug = debug
+        self.engine = 'tessapi'
+        self.engine_args = []
+        if libtesseract:
+            self.engine_args = ['--libtesseract', libtesseract]
+
+        # The idle workers for each configuration, and the number of
+        # workers running (idle or busy); these are protected by cond
+        self.idle = {}
+        self.running = 0
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def acquire(self, config):
+        """Get an idle worker for config, starting one if need be"""
+
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise OCRError('OCR backend has been closed')
+                if self.idle.get(config):
+                    return self.idle[config].pop()
+                if self.running < self.workers:
+                    self.running += 1
+                    break
+                # make room by stopping the least recently used idle
+                # worker for some other configuration
+                others = [w for ws in self.idle.values() for w in ws]
+                if others:
+                    oldest = min(others, key=lambda w: w.lastused)
+                    self.idle[oldest.config].remove(oldest)
+                    oldest.stop()
+                    self.running -= 1
+                else:
+                    self.cond.wait()
+
+        if self.debug:
+            print('Starting tesseract worker for %s' % (config,),
+                  file=sys.stderr)
+        try:
+            return Worker(config, self.engine, self.engine_args,
+                          self.resolution, self.env, self.timeout)
+        except Exception:
+            self.release(None, False)
+            raise
+
+    def release(self, worker, ok):
+        """Return a worker to the pool, or stop it if not ok"""
+
+        with self.cond:
+            if ok and not self.closed:
+                self.idle.setdefault(worker.config, []).append(worker)
+            else:
+                if worker is not None:
+                    worker.stop()
+                self.running -= 1
+            self.cond.notify()
+
+    def ocr(self, imgdir, image, outbase, config):
+        config = tuple(config)
+        for attempt in range(self.retries + 1):
+            worker = self.acquire(config)
+            try:
+                reply = worker.ocr(imgdir, image, outbase)
+            except OCRError as err:
+                self.release(worker, False)
+                error = err
+                continue
+            except BaseException:
+                self.release(worker, False)
+                raise
+            self.release(worker, True)
+            if not reply['ok']:
+                raise OCRError('tesseract failed on %s: %s' %
+                               (os.path.join(imgdir, image), reply['error']))
+            return
+        raise OCRError('%s (on %s)' % (error, os.path.join(imgdir, image)))
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            for ws in self.idle.values():
+                for worker in ws:
+                    worker.stop()
+                    self.running -= 1
+            self.idle = {}
+            self.cond.notify_all()
+
+
+class StubBackend(PoolBackend):
+    def __init__(self, workers=1, env=None, resolution=60, timeout=None,
+                 retries=1, hocr=None, delay=0, fail=None, crash=None,
+                 debug=False):
+        """A pool of stub workers returning canned hOCR
+
+        hocr is a file of canned hOCR to return (by default, a short
+        built-in page); each image takes delay seconds, and images
+        matching the glob pattern fail have an error reported, while
+        those matching crash kill the worker.
+        """
+
+        PoolBackend.__init__(self, workers=workers, env=env,
+                             resolution=resolution, timeout=timeout,
+                             retries=retries, debug=debug)
+        self.engine = 'stub'
+        self.cache_tag = 'stub:%s' % hocr
+        self.engine_args = ['--delay', str(delay)]
+        if hocr:
+            self.engine_args += ['--hocr', os.path.abspath(hocr)]
+        if fail:
+            self.engine_args += ['--fail', fail]
+        if crash:
+            self.engine_args += ['--crash', crash]
+
+
+backends = {'cli': CliBackend,
+            'pool': PoolBackend,
+            'stub': StubBackend}
+
+
+# What follows is run in the worker processes.  An engine is given the
+# worker's configuration and returns a function ocr(image, outbase)
+# which writes outbase.hocr and outbase.txt in the current directory,
+# raising an exception if this fails.
+
+def tessapi_engine(config, resolution, options):
+    """An engine using the C API of the modified libtesseract
+
+    The model is loaded once; each image is then processed with
+    TessBaseAPIProcessPages and the hOCR and text renderers, which is
+    what the tesseract command line program does, so the outputs are
+    the same.  The txt and hocr configs are loaded as the command line
+    program loads them.
+    """
+
+    libpath = options.libtesseract or ctypes.util.find_library('tesseract')
+    if not libpath:
+        raise Exception('cannot find libtesseract')
+    lib = ctypes.CDLL(libpath)
+
+    vp = ctypes.c_void_p
+    cp = ctypes.c_char_p
+    cpp = ctypes.POINTER(cp)
+    lib.TessBaseAPICreate.restype = vp
+    lib.TessBaseAPIInit4.argtypes = [vp, cp, cp, ctypes.c_int, cpp,
+                                     ctypes.c_int, cpp, cpp, ctypes.c_size_t,
+                                     ctypes.c_int]
+    lib.TessBaseAPISetPageSegMode.argtypes = [vp, ctypes.c_int]
+    lib.TessBaseAPISetOutputName.argtypes = [vp, cp]
+    lib.TessTextRendererCreate.restype = vp
+    lib.TessTextRendererCreate.argtypes = [cp]
+    lib.TessHOcrRendererCreate.restype = vp
+    lib.TessHOcrRendererCreate.argtypes = [cp]
+    lib.TessResultRendererInsert.argtypes = [vp, vp]
+    lib.TessDeleteResultRenderer.argtypes = [vp]
+    lib.TessBaseAPIProcessPages.argtypes = [vp, cp, cp, ctypes.c_int, vp]
+
+    (tessdata, scaling, blur) = config
+    variables = [('user_defined_dpi', '300')]
+    variables += tess_variables(config, resolution)
+    names = (cp * len(variables))(*[v[0].encode() for v in variables])
+    values = (cp * len(variables))(*[v[1].encode() for v in variables])
+    configs = (cp * 2)(b'txt', b'hocr')
+
+    api = lib.TessBaseAPICreate()
+    # 3 is OEM_DEFAULT, and the final 0 says to set debug parameters too
+    if lib.TessBaseAPIInit4(api, os.fsencode(tessdata), b'eng', 3,
+                            configs, 2, names, values, len(variables),
+                            0) != 0:
+        raise Exception('cannot load eng.traineddata from %s' % tessdata)
+    lib.TessBaseAPISetPageSegMode(api, 6)
+
+    def ocr(image, outbase):
+        outb = os.fsencode(outbase)
+        lib.TessBaseAPISetOutputName(api, outb)
+        renderer = lib.TessTextRendererCreate(outb)
+        lib.TessResultRendererInsert(renderer,
+                                     lib.TessHOcrRendererCreate(outb))
+        try:
+            if not lib.TessBaseAPIProcessPages(api, os.fsencode(image), None,
+                                               0, renderer):
+                raise Exception('tesseract could not process %s' % image)
+        finally:
+            # this also deletes the hOCR renderer
+            lib.TessDeleteResultRenderer(renderer)
+
+    return ocr
+
+
+canned_hocr = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+    "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+ <head>
+  <title></title>
+<meta http-equiv="Content-Type" content="text/html;charset=utf-8" />
+  <meta name='ocr-system' content='tesseract 4.1.1' />
+  <meta name='ocr-capabilities' content='ocr_page ocr_carea ocr_par ocr_line ocrx_word ocrp_wconf'/>
+ </head>
+ <body>
+  <div class='ocr_page' id='page_1' title='image "canned.png"; bbox 0 0 1200 300; ppageno 0'>
+   <div class='ocr_carea' id='block_1_1' title="bbox 100 100 1000 160">
+    <p class='ocr_par' id='par_1_1' lang='eng' title="bbox 100 100 1000 160">
+     <span class='ocr_line' id='line_1_1' title="bbox 100 100 1000 160; baseline 0 -10; x_size 60; x_descenders 12; x_ascenders 16">
+      <span class='ocrx_word' id='word_1_1' title='bbox 100 100 400 160; x_wconf 91'>Canned</span>
+      <span class='ocrx_word' id='word_1_2' title='bbox 450 100 650 160; x_wconf 88'>stub</span>
+      <span class='ocrx_word' id='word_1_3' title='bbox 700 100 1000 160; x_wconf 93'>output.</span>
+     </span>
+    </p>
+   </div>
+  </div>
+ </body>
+</html>
+'''
+
+
+def hocr_text(hocr):
+    """The plain text of an hOCR page, roughly as tesseract makes it"""
+
+    from lxml import etree
+
+    root = etree.fromstring(hocr.encode(), etree.HTMLParser())
+    pars = []
+    for par in root.iterfind('.//p'):
+        lines = []
+        for line in par.iterfind('span'):
+            lines.append(' '.join(''.join(word.itertext())
+                                  for word in line.iterfind('span')))
+        pars.append('\n'.join(lines) + '\n')
+    return '\n'.join(pars) + '\f'
+
+
+def stub_engine(config, resolution, options):
+    """An engine returning canned hOCR rather than running tesseract
+
+    The hOCR is the contents of options.hocr, or canned_hocr if that is
+    not given, with the image name changed to that of the image.
+    Processing each image takes options.delay seconds; images matching
+    the options.fail pattern have an error reported, and those matching
+    options.crash make the worker exit without replying.
+    """
+
+    if options.hocr:
+        canned = open(options.hocr).read()
+    else:
+        canned = canned_hocr
+
+    def ocr(image, outbase):
+        time.sleep(options.delay)
+        if options.crash and fnmatch.fnmatch(image, options.crash):
+            os._exit(1)
+        if options.fail and fnmatch.fnmatch(image, options.fail):
+            raise Exception('stub failure on %s' % image)
+        hocr = re.sub(r'image "[^"]*"', lambda m: 'image "%s"' % image,
+                      canned, count=1)
+        with open(outbase + '.hocr', 'w') as hocrfile:
+            print(hocr, end='', file=hocrfile)
+        with open(outbase + '.txt', 'w') as txtfile:
+            print(hocr_text(hocr), end='', file=txtfile)
+
+    return ocr
+
+
+engines = {'tessapi': tessapi_engine,
+           'stub': stub_engine}
+
+
+def run_worker(options):
+    # Our replies go to the original standard output; anything that
+    # tesseract prints there is sent to standard error instead
+    replies = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+
+    def reply(error=None):
+        if error is None:
+            print(json.dumps({'ok': True}), file=replies, flush=True)
+        else:
+            print(json.dumps({'ok': False, 'error': str(error)}),
+                  file=replies, flush=True)
+
+    config = tuple(json.loads(options.config))
+    try:
+        ocr = engines[options.engine](config, options.resolution, options)
+    except Exception as err:
+        reply(err)
+        return
+    reply()
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            os.chdir(request['cwd'])
+            ocr(request['image'], request['outbase'])
+        except Exception as err:
+            reply(err)
+        else:
+            reply()
+
+
+arg_parser = argparse.ArgumentParser(
+    description='Worker process for the pool OCR backend (see the '
+                'comments at the top of this program)')
+
+arg_parser.add_argument('--engine', choices=sorted(engines),
+                        default='tessapi', help='How to do the OCR')
+arg_parser.add_argument('--config', required=True,
+                        help='JSON [tessdata, scaling, blur] list')
+arg_parser.add_argument('--resolution', type=int, default=60,
+                        help='Resolution of the images (default 60)')
+arg_parser.add_argument('--libtesseract',
+                        help='Path to the modified libtesseract')
+arg_parser.add_argument('--hocr',
+                        help='Canned hOCR file for the stub engine')
+arg_parser.add_argument('--delay', type=float, default=0,
+                        help='Seconds per image for the stub engine')
+arg_parser.add_argument('--fail',
+                        help='Image pattern on which the stub engine fails')
+arg_parser.add_argument('--crash',
+                        help='Image pattern on which the stub engine '
+                             'crashes')
+
+if __name__ == '__main__':
+    run_worker(arg_parser.parse_args())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Send images to the ocr_images.py service and wait for the results
+
+Command line: $0 [options] SOCKET <img>.png [<img>.png ...]
+
+The service must already be running, having been started with
+ocr_images.py --serve SOCKET and the tessdata, backend and other
+options to use.  One job is sent for each image, and this waits until
+all of them have been processed.  The output files are the same as
+running ocr_images.py on each image in turn.
+
+This only uses the standard library, so that it starts quickly; the
+modules needed to process the images are already loaded by the
+service.
+"""
+
+import sys
+import os
+import json
+import socket
+import argparse
+
+
+def submit(path, records):
+    """Send the job records to the service at path and return the replies"""
+
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+        sock.sendall(b''.join((json.dumps(record) + '\n').encode()
+                              for record in records))
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('rb') as replies:
+            return [json.loads(line) for line in replies]
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Sends images to the ocr_images.py service')
+    arg_parser.add_argument('-s', '--scalings',
+                            help='Scalings/blurs to use (default: those '
+                                 'given to the service)')
+    arg_parser.add_argument('--scaling-set', action='append',
+                            help='Process each image with this comma-'
+                                 'separated set of scalings (may be '
+                                 'repeated)')
+    arg_parser.add_argument('-g', '--ground-truth',
+                            help='Ground truth text file (default is image '
+                                 'name with .gt.txt extension)')
+    arg_parser.add_argument('--outbase',
+                            help='basename of output files; default is '
+                                 'basename of input image file')
+    arg_parser.add_argument('socket', help='Socket of the service')
+    arg_parser.add_argument('image', nargs='+', help='Images to process')
+    args = arg_parser.parse_args()
+
+    if (args.outbase or args.ground_truth) and len(args.image) > 1:
+        arg_parser.error('--outbase and -g can only be used with one image')
+
+    records = []
+    for image in args.image:
+        # the service may be running in another directory
+        record = {'image': os.path.abspath(image)}
+        if args.outbase:
+            record['outbase'] = args.outbase
+        if args.ground_truth:
+            record['gt'] = args.ground_truth
+        if args.scaling_set or args.scalings:
+            record['scalings'] = args.scaling_set or [args.scalings]
+        records.append(record)
+
+    try:
+        replies = submit(args.socket, records)
+    except OSError as err:
+        print('Cannot reach the service on %s: %s' % (args.socket, err),
+              file=sys.stderr)
+        sys.exit(1)
+
+    failed = 0
+    for (image, reply) in zip(args.image, replies):
+        if not reply['ok']:
+            print('Failed to process %s: %s' % (image, reply['error']),
+                  file=sys.stderr)
+            failed += 1
+    if len(replies) < len(records):
+        print('The service stopped before processing %d images' %
+              (len(records) - len(replies)), file=sys.stderr)
+        failed += len(records) - len(replies)
+    if failed:
+        sys.exit(1)
@@ -9,16 +9,28 @@
 
 import sys
 import os
-import subprocess
-# import json
+import glob
+import json
+import csv
 import argparse
+import multiprocessing
+import signal
+import socket
+import socketserver
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
 from PIL import Image
 import parse_hocr
 import compare_hocr
 import hocr_metrics
+import ocr_backends
+from ocrcache import OCRCache
+from ocrpage import OCRPage
 
 """
 Command line: $0 [options] <img>.png
+              $0 [options] --batch INPUT [INPUT ...]
+              $0 [options] --serve SOCKET
 
 This program will process the image with tesseract,
 and the resulting .hocr file(s) will have .hocr in place of .png.
@@ -29,8 +41,591 @@ If there is a known ground truth, it should be saved as <img>.gt.txt,
 or specified on the command line.  The Levenstein distances will be
 calculated if this file exists, and the results will be output to
 <img>.metrics
+
+The tesseract runs for the different scalings are made concurrently (up
+to --jobs at a time), and each result is parsed as soon as it is ready;
+the merged result is the same whatever order they finish in.  By
+default, each run is a separate run of the tesseract program, which
+loads the model afresh; with --backend pool, a tesseract worker is kept
+running for each scaling instead, and --backend stub returns canned
+hOCR for trying things out without the modified tesseract (see
+ocr_backends.py).
+
+With --batch, every image in the inputs is processed, with the same
+per-image outputs as running this program on each image (and each
+scaling set) in turn.  Each INPUT is a directory (every .png file in it
+is processed), a glob pattern, or a JSON lines manifest (ending .jsonl)
+with one record per image, such as:
+
+    {"image": "dir/page-simulated-60dpi.png", "outbase": "page",
+     "gt": "page.gt.txt", "scalings": ["C0", "L0", "C0,L0"]}
+
+where all but "image" are optional ("outbase" and "gt" are relative to
+the image's directory, as with --outbase and -g, and the scaling sets
+default to those given by --scaling-set or -s).  All of the (image,
+scaling) tesseract runs are scheduled together, largest images first,
+and each image is parsed and merged in a pool of worker processes as
+soon as its runs have finished.  At the end, the metrics of every
+merged result are written to a single CSV table.
+
+With --serve SOCKET, this program instead runs as a service, listening
+on the Unix socket SOCKET, so that the modules, dictionary and (with
+--backend pool) tesseract models are loaded once rather than for every
+image.  Each job is a JSON line in the manifest format above, and is
+processed just as running this program on the image (with each of its
+scaling sets) would, with the other options given to the service.  A
+JSON line is sent back for each job, such as:
+
+    {"ok": true, "image": "dir/page.png",
+     "results": [{"scalings": "C0,L0", "metrics": "..."}]}
+
+where "metrics" is the CSV metrics of the merged result (or null if
+there is no ground truth), or {"ok": false, "error": "..."} if the job
+failed.  ocr_client.py sends jobs to the service and waits for them to
+finish.  With --serve -, the jobs are read from standard input and the
+replies written to standard output instead, processing one job at a
+time.
 """
 
+# The OCR result cache, if --cache is given
+cache = None
+
+scaling_types = {'B': (0, 'box'),
+                 'L': (1, 'bilinear'),
+                 'C': (2, 'bicubic')}
+
+
+def init_worker(worker_args):
+    """Set up the tesseract settings for this process
+
+    This is called in each batch worker process, and in the main
+    process.
+    """
+
+    global args, debug, tessbin, tessenv
+
+    args = worker_args
+    debug = args.debug
+
+    if args.tessbin_dir:
+        tessbin = os.path.join(args.tessbin_dir, 'tesseract')
+    else:
+        tessbin = 'tesseract'
+
+    if args.resolution == 0:
+        args.resolution = 60
+
+    # The environment for tesseract; we do not modify os.environ, as the
+    # tesseract runs have different TESSDATA_PREFIX settings
+    tessenv = dict(os.environ)
+    if args.tessenv:
+        for env in args.tessenv:
+            if '=' in env:
+                var, val = env.split('=', maxsplit=1)
+                tessenv[var] = val
+            else:
+                print('--tessenv value does not have an = in it: %s' % env)
+                print('ignoring this environment variable')
+
+
+def prepare_image(image, outbase=None, ground_truth=None):
+    """Work out the names for processing an image, and read its ground truth
+
+    This also makes the simulated low resolution image if --simulate
+    was given.  Returns a dict describing the image; all of the file
+    names in it are relative to its 'imgdir'.
+    """
+
+    imgdir, imgfn = os.path.split(image)
+    imgbase, imgext = os.path.splitext(imgfn)
+    job = {'image': image, 'imgdir': imgdir, 'outbase': outbase or imgbase,
+           'force': args.force}
+
+    if args.simulate:
+        img = Image.open(os.path.join(imgdir, imgfn))
+        if img.mode == '1':
+            img = img.convert(mode='L')
+
+        # Our target images are 300 dpi
+        if 300 % args.resolution != 0:
+            print('Warning: resolution %d is not a factor of 300; '
+                  'using rounded quotient instead!' % args.resolution)
+        factor = 300 // args.resolution
+
+        (wd, ht) = img.size
+        img = img.resize((wd // factor, ht // factor), resample=Image.BOX)
+        imggbase = imgbase + '-simulated-%ddpi' % args.resolution
+        simpath = os.path.join(imgdir, imggbase + '.png')
+        if args.force_image or not os.path.isfile(simpath):
+            img.save(simpath)
+            job['force'] = True
+    else:
+        imggbase = imgbase
+    job['imggbase'] = imggbase
+
+    try:
+        if ground_truth:
+            gt = open(os.path.join(imgdir, ground_truth)).read()
+        else:
+            gt = open(os.path.join(imgdir, imgbase + '.gt.txt')).read()
+    except OSError:
+        gt = None
+        print('Failed to read ground truth file; skipping comparisons')
+    job['gt'] = gt
+
+    return job
+
+
+def scaling_outputs(job, scalings):
+    """List the (scaling, imgout) pairs for the valid scalings"""
+
+    outputs = []
+    for scaling in scalings:
+        if scaling[0] not in scaling_types:
+            print('Unknown scaling type %s' % scaling[0])
+            continue
+        outputs.append((scaling,
+                        job['outbase'] + '-' + scaling.replace('.', '')))
+    return outputs
+
+
+def needs_run(job, imgout):
+    # With a cache, run_tesseract decides whether tesseract is needed
+    return (cache is not None or job['force'] or
+            not os.path.isfile(os.path.join(job['imgdir'], imgout + '.hocr')))
+
+
+def make_backend(jobs, omp_threads, nconfigs=1):
+    """Make the OCR backend chosen by --backend (see ocr_backends.py)
+
+    jobs is the number of tesseract runs that will be made at once, and
+    nconfigs the number of different scalings they will use.
+    """
+
+    if args.backend == 'cli':
+        return ocr_backends.CliBackend(tessbin, env=tessenv,
+                                       resolution=args.resolution,
+                                       omp_threads=omp_threads, debug=debug)
+
+    # By default keep a worker for each scaling, so that no model needs
+    # to be loaded more than once
+    workers = args.ocr_workers or max(jobs, nconfigs)
+    if args.backend == 'pool':
+        return ocr_backends.PoolBackend(workers=workers, env=tessenv,
+                                        resolution=args.resolution,
+                                        omp_threads=omp_threads,
+                                        timeout=args.ocr_timeout,
+                                        libtesseract=args.libtesseract,
+                                        debug=debug)
+    return ocr_backends.StubBackend(workers=workers, env=tessenv,
+                                    resolution=args.resolution,
+                                    timeout=args.ocr_timeout,
+                                    hocr=args.stub_hocr, debug=debug)
+
+
+def run_tesseract(backend, job, scaling, imgout):
+    """Run tesseract on the image with the given scaling and blur"""
+
+    scaling_type = scaling_types[scaling[0]]
+    blur = scaling[1:]
+
+    ddir = args.tessdata.replace('RES', str(args.resolution))
+
+    ddir = ddir.replace('SCALING', scaling_type[1])
+    ddir = ddir.replace('BLUR', blur)
+
+    ddir = os.path.join(args.tessdata_path, ddir, 'eng')
+    config = (ddir, scaling_type[0], blur)
+    if cache is not None:
+        cache.ocr(backend, job['imgdir'], job['imggbase'] + '.png', imgout,
+                  config, args.resolution, force=job['force'])
+    else:
+        backend.ocr(job['imgdir'], job['imggbase'] + '.png', imgout, config)
+
+
+def parse_result(job, imgout):
+    """Parse the hOCR output of one tesseract run into an OCRPage
+
+    This also produces the word-level metrics if requested.
+    """
+
+    imgdir = job['imgdir']
+    tidied = OCRPage.read_hocr(
+        os.path.join(imgdir, imgout + '.hocr'), resolution=args.resolution,
+        tag_id=imgout + '.hocr')
+
+    # produce word-level metrics if requested
+    if args.wmetrics:
+        if job['gt'] is not None:
+            hocr_metrics.compute_hocr_diff(tidied, job['gt'])
+            hocr_metrics.output_hocr_diff_metrics(
+                tidied, os.path.join(imgdir, imgout + '-wmetrics.csv'))
+
+    return tidied
+
+
+def merge_results(job, scalings, outputs, pages):
+    """Merge the parsed pages for some scalings and write the results
+
+    outputs is the list from scaling_outputs, and pages is a dict of
+    the parsed pages, keyed by output basename.  Returns the CSV metrics
+    of the merged result (or None if there is no ground truth or nothing
+    was processed).
+    """
+
+    if not outputs:
+        print('No processing done; exiting')
+        return None
+
+    imgdir = job['imgdir']
+    outbase = job['outbase']
+    gt = job['gt']
+    scalingsstr = ''.join(scalings).replace('.', '')
+    orighocr = open(os.path.join(imgdir, outputs[0][1] + '.hocr')).read()
+
+    out123 = compare_hocr.merge_ocr_pages(
+        [pages[imgout] for (scaling, imgout) in outputs], debug)
+
+    # update the hocr string to reflect the changes we've made
+    hocr123 = compare_hocr.update_hocr(orighocr, out123)
+    with open(os.path.join(imgdir, outbase + '-merged-%s.hocr' %
+                           scalingsstr), 'w') as hocrout:
+        print(hocr123, end='', file=hocrout)
+
+    out123txt = out123.text()
+    with open(os.path.join(imgdir, outbase + '-merged-%s.txt' %
+                           scalingsstr), 'w') as mergedtxt:
+        print(out123txt, file=mergedtxt)
+
+    if gt is None:
+        return None
+
+    mergedfile = outbase + '-merged-%s.metrics' % scalingsstr
+    mergedcsv = outbase + '-merged-%s.csv' % scalingsstr
+    imgfilename = outbase + '-merged-%s' % scalingsstr
+    cmptxt, cmpcsv = hocr_metrics.get_metrics(out123txt, gt, imgfilename)
+
+    with open(os.path.join(imgdir, mergedfile), 'w') as metrics:
+        print(cmptxt, end='', file=metrics)
+    with open(os.path.join(imgdir, mergedcsv), 'w') as metrics:
+        print(cmpcsv, end='', file=metrics)
+    return cmpcsv
+
+
+def process_scaling_sets(job, scaling_sets):
+    """Parse and merge the results for each scaling set of an image
+
+    The tesseract runs must already have been made.  This is what a
+    batch worker process does for each image; each scaling set is
+    processed just as a separate run of this program would.  Returns a
+    list of (scaling set, CSV metrics) pairs.
+    """
+
+    results = []
+    for scalings in scaling_sets:
+        scalings = scalings.split(',')
+        outputs = scaling_outputs(job, scalings)
+        pages = {}
+        for (scaling, imgout) in outputs:
+            if imgout not in pages:
+                pages[imgout] = parse_result(job, imgout)
+        results.append((','.join(scalings),
+                        merge_results(job, scalings, outputs, pages)))
+    return results
+
+
+def process_image(image, outbase=None, ground_truth=None, scaling_sets=None,
+                  backend=None):
+    """Process a single image with each of the scaling sets
+
+    This is what is done for the image given on the command line (with
+    the -s scalings), and for each job sent to the service.  If backend
+    is None, a backend is made for this image.  Returns a list of
+    (scaling set, CSV metrics) pairs, as process_scaling_sets does.
+    """
+
+    job = prepare_image(image, outbase, ground_truth)
+    sets = [(scalings, scaling_outputs(job, scalings.split(',')))
+            for scalings in scaling_sets or [args.scalings]]
+
+    torun = []
+    for (scalings, outputs) in sets:
+        for (scaling, imgout) in outputs:
+            if (needs_run(job, imgout) and
+                    imgout not in [run[1] for run in torun]):
+                torun.append((scaling, imgout))
+
+    jobs = args.jobs or min(max(len(torun), 1), os.cpu_count() or 1)
+    if args.omp_threads:
+        omp_threads = args.omp_threads
+    elif jobs > 1 and len(torun) > 1:
+        omp_threads = 1
+    else:
+        omp_threads = None
+
+    if backend is None:
+        with make_backend(jobs, omp_threads, len(torun)) as backend:
+            pages = run_image(job, sets, torun, backend, jobs)
+    else:
+        pages = run_image(job, sets, torun, backend, jobs)
+
+    return [(scalings, merge_results(job, scalings.split(','), outputs,
+                                     pages))
+            for (scalings, outputs) in sets]
+
+
+def run_image(job, sets, torun, backend, jobs):
+    """Make the tesseract runs for an image, and parse all of the results
+
+    Returns a dict of the parsed pages, keyed by output basename.
+    """
+
+    # Parse each result as soon as it is ready; the pages are then put
+    # back into scaling order by merge_results
+    pages = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run_tesseract, backend, job, scaling,
+                                   imgout): imgout
+                   for (scaling, imgout) in torun}
+        for (scalings, outputs) in sets:
+            for (scaling, imgout) in outputs:
+                if imgout not in futures.values() and imgout not in pages:
+                    pages[imgout] = parse_result(job, imgout)
+        for future in as_completed(futures):
+            future.result()
+            pages[futures[future]] = parse_result(job, futures[future])
+    return pages
+
+
+def batch_images(inputs):
+    """Find the images to process in batch mode
+
+    Returns a list of (image, outbase, ground truth, scaling sets)
+    tuples; see the comments at the top of this file.
+    """
+
+    default_sets = args.scaling_set or [args.scalings]
+    images = []
+    for inp in inputs:
+        if os.path.isdir(inp):
+            paths = sorted(glob.glob(os.path.join(glob.escape(inp),
+                                                  '*.png')))
+        elif inp.endswith('.jsonl'):
+            with open(inp) as f:
+                for line in f:
+                    if line.strip() == '':
+                        continue
+                    record = json.loads(line)
+                    images.append((record['image'], record.get('outbase'),
+                                   record.get('gt'),
+                                   record.get('scalings', default_sets)))
+            continue
+        else:
+            paths = sorted(glob.glob(inp))
+        images.extend((path, None, None, default_sets) for path in paths)
+    return images
+
+
+def image_area(job):
+    try:
+        with Image.open(os.path.join(job['imgdir'],
+                                     job['imggbase'] + '.png')) as img:
+            return img.size[0] * img.size[1]
+    except OSError:
+        return 0
+
+
+def process_batch(inputs):
+    """Process all of the images in the inputs, as described above
+
+    The tesseract runs are made by a pool of threads (each running
+    tesseract in its own process), and the parsing and merging is done
+    by a pool of worker processes.  Returns a list of rows for the
+    metrics table, and a list of the images which failed.
+    """
+
+    jobs = args.jobs or os.cpu_count() or 1
+    omp_threads = args.omp_threads or 1
+
+    images = []
+    runs = []
+    for (image, outbase, ground_truth, scaling_sets) in batch_images(inputs):
+        job = prepare_image(image, outbase, ground_truth)
+        job['sets'] = scaling_sets
+        job['pending'] = set()
+        for scalings in scaling_sets:
+            for (scaling, imgout) in scaling_outputs(job, scalings.split(',')):
+                if needs_run(job, imgout) and imgout not in job['pending']:
+                    job['pending'].add(imgout)
+                    runs.append((image_area(job), len(images), scaling,
+                                 imgout))
+        images.append(job)
+
+    # largest first, so that a big image is not left until the end
+    runs.sort(key=lambda run: -run[0])
+
+    # The worker processes are started afresh rather than forked, as
+    # forking while the tesseract threads are running can deadlock
+    rows = []
+    failed = []
+    nconfigs = len(set(run[2] for run in runs))
+    with make_backend(jobs, omp_threads, nconfigs) as backend, \
+            ThreadPoolExecutor(max_workers=jobs) as tesspool, \
+            ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                initargs=(args,),
+                                mp_context=multiprocessing.get_context(
+                                    'spawn')) as workpool:
+        merges = {}
+        for i, job in enumerate(images):
+            if not job['pending']:
+                merges[workpool.submit(process_scaling_sets, job,
+                                       job['sets'])] = i
+        futures = {tesspool.submit(run_tesseract, backend, images[i],
+                                   scaling, imgout): (i, imgout)
+                   for (area, i, scaling, imgout) in runs}
+        for future in as_completed(futures):
+            (i, imgout) = futures[future]
+            job = images[i]
+            try:
+                future.result()
+            except Exception as err:
+                print('tesseract failed on %s: %s' % (job['image'], err),
+                      file=sys.stderr)
+                job['failed'] = True
+            job['pending'].discard(imgout)
+            if not job['pending'] and not job.get('failed'):
+                merges[workpool.submit(process_scaling_sets, job,
+                                       job['sets'])] = i
+            elif not job['pending']:
+                failed.append(job['image'])
+
+        for future in as_completed(merges):
+            job = images[merges[future]]
+            try:
+                results = future.result()
+            except Exception as err:
+                print('Failed to process %s: %s' % (job['image'], err),
+                      file=sys.stderr)
+                failed.append(job['image'])
+                continue
+            for (scalings, cmpcsv) in results:
+                if cmpcsv is not None:
+                    # the second line of the CSV has the values
+                    values = next(csv.reader(cmpcsv.splitlines()[1:]))
+                    rows.append((merges[future], scalings,
+                                 [job['image']] + values))
+
+    # put the table into input order
+    rows.sort(key=lambda row: row[0])
+    return [[row[2][0], row[1]] + row[2][1:] for row in rows], failed
+
+
+def run_service_job(request, backend):
+    """Process one job sent to the service, returning the reply"""
+
+    try:
+        record = json.loads(request)
+        results = process_image(record['image'], record.get('outbase'),
+                                record.get('gt'), record.get('scalings'),
+                                backend)
+    except Exception as err:
+        print('Failed to process job %s: %s' % (request.strip(), err),
+              file=sys.stderr)
+        return {'ok': False, 'error': '%s: %s' % (type(err).__name__, err)}
+
+    return {'ok': True, 'image': record['image'],
+            'results': [{'scalings': scalings, 'metrics': cmpcsv}
+                        for (scalings, cmpcsv) in results]}
+
+
+class ServiceHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if line.strip() == b'':
+                continue
+            reply = run_service_job(line.decode('utf-8', 'replace'),
+                                    self.server.backend)
+            self.wfile.write((json.dumps(reply) + '\n').encode())
+
+
+def serve_socket(path, backend):
+    """Process the jobs sent to the Unix socket path, until we are stopped
+
+    Each connection is handled in its own thread, so several clients
+    can be served at once.
+    """
+
+    if os.path.exists(path):
+        # remove the socket left by a service which has stopped, but
+        # not that of one which is still running
+        with socket.socket(socket.AF_UNIX) as sock:
+            try:
+                sock.connect(path)
+            except ConnectionRefusedError:
+                os.remove(path)
+            else:
+                print('A service is already running on %s' % path,
+                      file=sys.stderr)
+                sys.exit(1)
+
+    with socketserver.ThreadingUnixStreamServer(path,
+                                                ServiceHandler) as server:
+        server.backend = backend
+        server.daemon_threads = True
+        print('Serving on %s' % path, file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
+
+
+def serve_stream(backend):
+    """Process the jobs read from standard input, one at a time
+
+    The replies are written to standard output, so anything else that
+    is printed while processing the jobs goes to standard error.
+    """
+
+    replies = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+
+    for line in sys.stdin:
+        if line.strip() == '':
+            continue
+        print(json.dumps(run_service_job(line, backend)), file=replies,
+              flush=True)
+
+
+def serve(path):
+    """Run as a service, as described at the top of this file"""
+
+    # Load now what would otherwise be loaded for the first job
+    parse_hocr.load_dictionary()
+    parse_hocr.load_puncs()
+
+    # The cli backend keeps nothing loaded, so is made for each job
+    # just as it is on the command line, but the others keep their
+    # workers running between jobs
+    if args.backend == 'cli':
+        backend = None
+    else:
+        jobs = args.jobs or os.cpu_count() or 1
+        backend = make_backend(jobs, args.omp_threads or 1,
+                               len(args.scalings.split(',')))
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if path == '-':
+            serve_stream(backend)
+        else:
+            serve_socket(path, backend)
+    finally:
+        if backend is not None:
+            backend.close()
+
+
 arg_parser = argparse.ArgumentParser(
     description='Processes images with multiple tesseract runs')
 
@@ -72,149 +667,99 @@ arg_parser.add_argument('--tessdata', default='dataRES_SCALING+BLUR',
                              'BLUR is replaced by the blur amount')
 arg_parser.add_argument('-w', '--wmetrics', action='store_true',
                         help='Produce word-level metrics for image')
-arg_parser.add_argument('image', help='Image to process')
-
-args = arg_parser.parse_args()
-debug = args.debug
-
-if args.tessbin_dir:
-    tessbin = os.path.join(args.tessbin_dir, 'tesseract')
-else:
-    tessbin = 'tesseract'
-
-curdir = os.getcwd()
-
-imgdir, imgfn = os.path.split(args.image)
-imgbase, imgext = os.path.splitext(imgfn)
-if imgdir:
-    os.chdir(imgdir)
-if args.outbase:
-    outbase = args.outbase
-else:
-    outbase = imgbase
-
-if args.tessenv:
-    for env in args.tessenv:
-        if '=' in env:
-            var, val = env.split('=', maxsplit=1)
-            os.environ[var] = val
-        else:
-            print('--tessenv value does not have an = in it: %s' % env)
-            print('ignoring this environment variable')
-
-if args.resolution == 0:
-    args.resolution = 60
-
-if args.simulate:
-    img = Image.open(imgfn)
-    if img.mode == '1':
-        img = img.convert(mode='L')
-
-    # Our target images are 300 dpi
-    if 300 % args.resolution != 0:
-        print('Warning: resolution %d is not a factor of 300; '
-              'using rounded quotient instead!' % args.resolution)
-    factor = 300 // args.resolution
-
-    (wd, ht) = img.size
-    img = img.resize((wd // factor, ht // factor), resample=Image.BOX)
-    imggbase = imgbase + '-simulated-%ddpi' % args.resolution
-    if args.force_image or not os.path.isfile(imggbase + '.png'):
-        img.save(imggbase + '.png')
-        args.force = True
-
-    (wd, ht) = img.size
-    imgbig = None
-else:
-    imggbase = imgbase
-
-pages = []
-scalings = args.scalings.split(',')
-scalingsstr = ''.join(scalings).replace('.', '')
-orighocr = None
-try:
-    if args.ground_truth:
-        gt = open(args.ground_truth).read()
-    else:
-        gt = open(imgbase + '.gt.txt').read()
-except OSError:
-    gt = None
-    print('Failed to read ground truth file; skipping comparisons')
-
-scaling_types = {'B': (0, 'box'),
-                 'L': (1, 'bilinear'),
-                 'C': (2, 'bicubic')}
-
-for scaling in scalings:
-    ext = '.png'
-    if scaling[0] not in scaling_types:
-        print('Unknown scaling type %s' % scaling[0])
-        continue
-
-    scaling_type = scaling_types[scaling[0]]
-    blur = scaling[1:]
-    scaling = scaling.replace('.', '')
-
-    imgout = outbase + '-' + scaling
-
-    if (args.force or not os.path.isfile(imgout + '.hocr')):
-        ddir = args.tessdata.replace('RES', str(args.resolution))
-
-        ddir = ddir.replace('SCALING', scaling_type[1])
-        ddir = ddir.replace('BLUR', blur)
-
-        ddir = os.path.join(args.tessdata_path, ddir, 'eng')
-        os.environ['TESSDATA_PREFIX'] = ddir
-        cmd = [tessbin,
-               '--dpi', '300', '-l', 'eng',
-               '-c', 'low_resolution_input=true',
-               '-c', 'low_resolution_dpi=%d' % args.resolution,
-               '-c', 'low_resolution_scaling=%d' % scaling_type[0],
-               '-c', 'low_resolution_blurring=%s' % blur,
-               '--psm', '6',
-               imggbase + ext, imgout, 'txt', 'hocr']
-        if debug:
-            print('About to run: %s' % ' '.join(cmd), file=sys.stderr)
-            print('TESSDATA_PREFIX = %s' % ddir)
-        subprocess.run(cmd, check=True)
-    tree, tidied = parse_hocr.parse_hocr_file(imgout + '.hocr',
-                                                  resolution=args.resolution)
-    pages.append(tidied)
-    if not orighocr:
-        orighocr = open(imgout + '.hocr').read()
-
-    # produce word-level metrics if requested
-    if args.wmetrics:
-        if gt is not None:
-            hocr_metrics.compute_hocr_diff(tidied, gt)
-            hocr_metrics.output_hocr_diff_metrics(tidied,
-                                                  imgout + '-wmetrics.csv')
-
-    del tree, tidied
-
-if not orighocr:
-    print('No processing done; exiting')
-else:
-    out123 = compare_hocr.merge_ocr_pages(pages, debug)
-
-    # update the hocr string to reflect the changes we've made
-    hocr123 = compare_hocr.update_hocr(orighocr, out123)
-    with open(outbase + '-merged-%s.hocr' % scalingsstr, 'w') as hocrout:
-        print(hocr123, end='', file=hocrout)
-
-    out123txt = parse_hocr.ocr_page_to_text(out123)
-    with open(outbase + '-merged-%s.txt' % scalingsstr, 'w') as mergedtxt:
-        print(out123txt, file=mergedtxt)
-
-    if gt is not None:
-        mergedfile = outbase + '-merged-%s.metrics' % scalingsstr
-        mergedcsv = outbase + '-merged-%s.csv' % scalingsstr
-        imgfilename = outbase + '-merged-%s' % scalingsstr
-        cmptxt, cmpcsv = hocr_metrics.get_metrics(out123txt, gt, imgfilename)
-
-        with open(mergedfile, 'w') as metrics:
-            print(cmptxt, end='', file=metrics)
-        with open(mergedcsv, 'w') as metrics:
-            print(cmpcsv, end='', file=metrics)
-
-os.chdir(curdir)
+arg_parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of tesseract runs to make at once '
+                             '(default: one per scaling, up to the number '
+                             'of CPUs; with --batch, the number of CPUs)')
+arg_parser.add_argument('--omp-threads', type=int,
+                        help='Limit each tesseract run to this many OpenMP '
+                             'threads (default: 1 if there is more than '
+                             'one run at once, otherwise no limit)')
+arg_parser.add_argument('--cache', metavar='DIR',
+                        help='Directory in which to cache the tesseract '
+                             'results, keyed by the contents of the image '
+                             'and traineddata files and the tesseract '
+                             'settings; tesseract is then run only if there '
+                             'is no cached result (or with -f), rather than '
+                             'whenever the .hocr file does not exist')
+arg_parser.add_argument('--cache-size', metavar='MB', type=int,
+                        help='Maximum size of the result cache in MB '
+                             '(default 1000)',
+                        default=1000)
+arg_parser.add_argument('--backend', choices=sorted(ocr_backends.backends),
+                        default='cli',
+                        help='How to run tesseract: cli runs the tesseract '
+                             'program for each image and scaling, pool '
+                             'keeps a tesseract worker running for each '
+                             'scaling, and stub returns canned hOCR for '
+                             'testing (default cli)')
+arg_parser.add_argument('--ocr-workers', type=int,
+                        help='With --backend pool or stub, the number of '
+                             'workers to keep running (default: the larger '
+                             'of --jobs and the number of scalings)')
+arg_parser.add_argument('--ocr-timeout', type=float,
+                        help='With --backend pool or stub, the time limit '
+                             'in seconds for each image')
+arg_parser.add_argument('--libtesseract',
+                        help='With --backend pool, the path to the modified '
+                             'libtesseract (default: search for it)')
+arg_parser.add_argument('--stub-hocr',
+                        help='With --backend stub, the canned hOCR file to '
+                             'return (default: a built-in page)')
+arg_parser.add_argument('--batch', action='store_true',
+                        help='Process all of the images in the inputs (see '
+                             'the comments at the top of this program)')
+arg_parser.add_argument('--scaling-set', action='append',
+                        help='With --batch, process each image with this '
+                             'comma-separated set of scalings (may be '
+                             'repeated; default is the -s scalings)')
+arg_parser.add_argument('--metrics-table', default='batch-metrics.csv',
+                        help='With --batch, write the metrics of all of '
+                             'the merged results to this CSV file '
+                             '(default batch-metrics.csv)')
+arg_parser.add_argument('--serve', metavar='SOCKET',
+                        help='Run as a service, processing the jobs sent to '
+                             'the Unix socket SOCKET (or read from standard '
+                             'input if SOCKET is -); see the comments at the '
+                             'top of this program')
+arg_parser.add_argument('image', nargs='*',
+                        help='Image to process (with --batch, the inputs)')
+
+if __name__ == '__main__':
+    init_worker(arg_parser.parse_args())
+    if args.cache:
+        cache = OCRCache(args.cache, maxsize=args.cache_size * 1024 ** 2)
+
+    if args.serve:
+        if args.image or args.batch or args.outbase or args.ground_truth:
+            arg_parser.error('images, --batch, --outbase and -g cannot be '
+                             'used with --serve; they are given in the jobs')
+        serve(args.serve)
+        sys.exit(0)
+
+    if not args.image:
+        arg_parser.error('the following arguments are required: image')
+
+    if not args.batch:
+        if len(args.image) > 1:
+            arg_parser.error('only one image can be given without --batch')
+        process_image(args.image[0], args.outbase, args.ground_truth)
+        sys.exit(0)
+
+    if args.outbase or args.ground_truth:
+        arg_parser.error('--outbase and -g cannot be used with --batch; '
+                         'use a manifest instead')
+
+    rows, failed = process_batch(args.image)
+    with open(args.metrics_table, 'w', newline='') as tablefile:
+        table = csv.writer(tablefile)
+        table.writerow(['Image', 'Scalings', 'Filename',
+                        'Chars', 'Words', 'C dist', 'W dist', 'CLA',
+                        'WLA', 'C dist quotes', 'W dist quotes',
+                        'CLA quotes', 'WLA quotes'])
+        table.writerows(rows)
+    if failed:
+        print('Failed to process %d images:' % len(failed), file=sys.stderr)
+        for image in failed:
+            print('  %s' % image, file=sys.stderr)
+        sys.exit(1)
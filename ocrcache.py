@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+An on-disk cache of the hOCR and text outputs of tesseract runs
+
+ocr_images.py used to skip running tesseract whenever the .hocr output
+file already existed, so a changed traineddata file, resolution or
+blur silently reused stale results.  This cache is instead keyed by a
+hash of the image file's contents, the traineddata file's contents and
+the full tesseract configuration, so that only (image, model, config)
+combinations which have genuinely changed are run again, and results
+can be shared between images with the same contents.
+
+As the hOCR records the name of the image file, this is replaced by the
+name of the image being processed when a result is taken from the
+cache, so that the outputs are the same as tesseract would produce.
+
+As with rendercache.py, the cache directory can be shared between
+concurrent processes: entries are written atomically, an entry
+vanishing under our feet is treated as a cache miss, and only one
+process at a time evicts entries.  When the total size of the cache
+exceeds its cap, the least recently used entries are removed.
+"""
+
+import os
+import re
+import json
+import hashlib
+import tempfile
+import threading
+import fcntl
+import ocr_backends
+
+# The hashes of files we have already read, keyed by their path, and
+# their size and modification time when we read them
+file_hashes = {}
+file_hashes_lock = threading.Lock()
+
+
+def file_hash(path):
+    """The SHA-256 hash of the contents of a file"""
+
+    st = os.stat(path)
+    stamp = (path, st.st_size, st.st_mtime_ns)
+    with file_hashes_lock:
+        if stamp in file_hashes:
+            return file_hashes[stamp]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    with file_hashes_lock:
+        file_hashes[stamp] = sha.hexdigest()
+    return file_hashes[stamp]
+
+
+def hocr_escape(text):
+    """Escape text as tesseract does in hOCR output"""
+
+    return (text.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;')
+            .replace("'", '&#39;'))
+
+
+image_title_re = re.compile(r'image "[^"]*"')
+
+
+class OCRCache:
+    def __init__(self, cachedir, maxsize=1024 ** 3):
+        """Use (and if necessary create) the cache in cachedir
+
+        maxsize is the maximum total size of the cache entries in bytes.
+        """
+
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        os.makedirs(cachedir, exist_ok=True)
+        self.lockfile = os.path.join(cachedir, 'evict.lock')
+        # Our estimate of the total size of the cache; this does not
+        # include entries added by other processes, so we also rescan
+        # the cache every so often, starting with the first put (rather
+        # than here, as scanning a large cache takes a while, and a
+        # process which only reads the cache need not do it).  The
+        # cache may be used by several threads, so these are protected
+        # by self.lock.
+        self.lock = threading.Lock()
+        self.totalsize = 0
+        self.puts = 0
+        self.rescan_every = 1000
+
+    def key(self, image, config, resolution, backend):
+        """Determine the hash key for running tesseract
+
+        image is the path of the image file, and config and resolution
+        are as for the OCR backends (see ocr_backends.py).  Returns None
+        if the image or traineddata file cannot be read, in which case
+        the result should not be cached.
+        """
+
+        try:
+            params = [file_hash(image),
+                      file_hash(os.path.join(config[0], 'eng.traineddata'))]
+        except OSError:
+            return None
+        # The language, dpi and page segmentation mode are always the
+        # same, but are included in case they are ever changed
+        params += ['eng', 300, 6,
+                   ocr_backends.tess_variables(config, resolution),
+                   backend.cache_tag]
+        return hashlib.sha256(json.dumps(params).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key[:2], key + '.json')
+
+    def get(self, key, imagename):
+        """Return the cached (hOCR, text) for key, or None
+
+        imagename is put into the hOCR as the name of the image file.
+        """
+
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            # either not there or removed while we were reading it
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        hocr = image_title_re.sub(
+            lambda m: 'image "%s"' % hocr_escape(imagename), entry['hocr'],
+            count=1)
+        return (hocr, entry['txt'])
+
+    def put(self, key, hocr, txt):
+        """Store the hOCR and text outputs in the cache under key"""
+
+        path = self.path(key)
+        keydir = os.path.dirname(path)
+        os.makedirs(keydir, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=keydir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as tmpfile:
+                json.dump({'hocr': hocr, 'txt': txt}, tmpfile)
+            os.replace(tmppath, path)
+        except Exception:
+            os.remove(tmppath)
+            raise
+
+        with self.lock:
+            self.totalsize += os.path.getsize(path)
+            self.puts += 1
+            evict = (self.totalsize > self.maxsize or
+                     (self.puts - 1) % self.rescan_every == 0)
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries if the cache is too big
+
+        This also recalculates our estimate of the total cache size.
+        The cache is reduced to 90% of its maximum size, so that we do
+        not have to evict on every subsequent put.
+        """
+
+        with open(self.lockfile, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # someone else is already doing this
+                return
+
+            entries = []
+            for dirpath, dirnames, filenames in os.walk(self.cachedir):
+                for fn in filenames:
+                    if not fn.endswith('.json'):
+                        continue
+                    path = os.path.join(dirpath, fn)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+
+            total = sum(entry[1] for entry in entries)
+            if total > self.maxsize:
+                entries.sort()
+                for (mtime, size, path) in entries:
+                    if total <= 0.9 * self.maxsize:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+
+            with self.lock:
+                self.totalsize = total
+
+    def ocr(self, backend, imgdir, image, outbase, config, resolution,
+            force=False):
+        """A cached version of backend.ocr
+
+        The outputs are taken from the cache if they are there (unless
+        force is True), and otherwise tesseract is run and its outputs
+        are added to the cache.  Returns True if tesseract was run.
+        """
+
+        key = self.key(os.path.join(imgdir, image), config, resolution,
+                       backend)
+        outpath = os.path.join(imgdir, outbase)
+        if key is not None and not force:
+            entry = self.get(key, image)
+            if entry is not None:
+                for (ext, contents) in zip(['.hocr', '.txt'], entry):
+                    with open(outpath + ext, 'w') as outfile:
+                        print(contents, end='', file=outfile)
+                return False
+
+        backend.ocr(imgdir, image, outbase, config)
+        if key is not None:
+            with open(outpath + '.hocr') as hocrfile:
+                hocr = hocrfile.read()
+            with open(outpath + '.txt') as txtfile:
+                txt = txtfile.read()
+            self.put(key, hocr, txt)
+        return True
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+A compact representation of a tidied OCR page
+
+A tidied page, as made by parse_hocr.tidy_ocr_page, is a tree of dicts,
+with a dict (and a bbox list) for every word, which takes hundreds of
+bytes per word, and can only be processed with Python loops.  An
+OCRPage instead keeps the bboxes and confidences of all of the words in
+NumPy arrays, with the words and ids held as indices into a shared
+table of strings.  The lines, paragraphs and areas are similarly held
+in arrays, and each level is grouped into the level above by an array
+of offsets: the words of line l are words starts['line'][l] to
+starts['line'][l + 1] - 1, and so on.  The line, par and area
+properties give the index of the line, paragraph and area of each word.
+
+An OCRPage can be used in place of a tidied page by existing code: it
+behaves as a read-only dict with 'areas' (and 'filename', if known),
+and page['areas'] is a list of views of the areas, which behave like
+the area dicts, and similarly for the paragraphs, lines and words.
+Assigning to the fields of a word view changes the page; other keys
+(such as 'readings') can also be set, and are kept in a dict for each
+word.  compare_hocr.merge_ocr_pages and the hocr_metrics functions use
+the arrays directly when given OCRPages.
+"""
+
+from collections.abc import Mapping
+import numpy as np
+import parse_hocr
+
+# The levels of the page, from the top down, and the key of each
+# level's children in the tidied page dicts
+levels = ['area', 'par', 'line', 'word']
+children = {'page': 'areas', 'area': 'pars', 'par': 'lines', 'line': 'words'}
+
+# The word fields held in arrays, in the order of the tidied word dicts
+word_fields = ['id', 'bbox', 'conf', 'word', 'dictconf', 'modconf']
+
+
+class OCRPage(Mapping):
+    def __init__(self, filename=None):
+        """Make an empty page; see from_dict and read_hocr"""
+
+        self.filename = filename
+        self.strings = []
+        self.string_index = {}
+        # the arrays for each level
+        self.ids = {}
+        self.bboxes = {}
+        self.starts = {}
+        for level in levels:
+            self.ids[level] = np.zeros(0, dtype=np.int32)
+            self.bboxes[level] = np.zeros((0, 4), dtype=np.int32)
+        for level in ['page'] + levels[:-1]:
+            self.starts[level] = np.zeros(1, dtype=np.int64)
+        self.words = np.zeros(0, dtype=np.int32)
+        self.conf = np.zeros(0, dtype=np.int32)
+        self.dictconf = np.zeros(0, dtype=np.int32)
+        self.modconf = np.zeros(0, dtype=np.int32)
+        # These are only present once the page has been processed by
+        # hocr_metrics.compute_hocr_diff and merge_ocr_pages
+        self.correct = None
+        self.idused = None
+        # any other word fields, keyed by word index
+        self.extras = {}
+
+    def intern(self, s):
+        """The index of s in the string table, adding it if need be"""
+
+        i = self.string_index.get(s)
+        if i is None:
+            i = self.string_index[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def string_array(self, strings):
+        return np.array([self.intern(s) for s in strings], dtype=np.int32)
+
+    @classmethod
+    def from_dict(cls, page):
+        """Make an OCRPage from a tidied page"""
+
+        self = cls(page.get('filename'))
+        items = {level: [] for level in levels}
+        counts = {level: [0] for level in ['page'] + levels[:-1]}
+
+        def collect(parent, level, node):
+            kids = node[children[parent]]
+            counts[parent].append(counts[parent][-1] + len(kids))
+            items[level].extend(kids)
+
+        collect('page', 'area', page)
+        for a in items['area']:
+            collect('area', 'par', a)
+        for p in items['par']:
+            collect('par', 'line', p)
+        for ln in items['line']:
+            collect('line', 'word', ln)
+
+        for level in levels:
+            self.ids[level] = self.string_array(x['id'] for x in items[level])
+            if items[level]:
+                self.bboxes[level] = np.array([x['bbox']
+                                               for x in items[level]],
+                                              dtype=np.int32)
+        for level in counts:
+            self.starts[level] = np.array(counts[level], dtype=np.int64)
+
+        words = items['word']
+        self.words = self.string_array(w['word'] for w in words)
+        for field in ['conf', 'dictconf', 'modconf']:
+            setattr(self, field, np.array([w[field] for w in words],
+                                          dtype=np.int32))
+        for i, w in enumerate(words):
+            extra = {k: v for (k, v) in w.items() if k not in word_fields}
+            if extra:
+                self.extras[i] = extra
+        return self
+
+    @classmethod
+    def read_hocr(cls, fn, resolution=60, tag_id=None):
+        """Read an hOCR file into an OCRPage
+
+        This takes the same arguments as parse_hocr.read_hocr_file.
+        """
+
+        return cls.from_dict(parse_hocr.read_hocr_file(
+            fn, resolution=resolution, tag_id=tag_id))
+
+    def to_dict(self):
+        """Make a tidied page (as plain dicts) from this page"""
+
+        return {k: v if k != 'areas' else [a.to_dict() for a in v]
+                for (k, v) in self.items()}
+
+    def copy(self):
+        """A copy of the page which can be changed independently"""
+
+        page = OCRPage(self.filename)
+        page.strings = list(self.strings)
+        page.string_index = dict(self.string_index)
+        for d in ['ids', 'bboxes', 'starts']:
+            setattr(page, d, {k: v.copy() for (k, v) in
+                              getattr(self, d).items()})
+        for field in ['words', 'conf', 'dictconf', 'modconf', 'correct',
+                      'idused']:
+            value = getattr(self, field)
+            setattr(page, field, None if value is None else value.copy())
+        page.extras = {i: dict(extra) for (i, extra) in self.extras.items()}
+        return page
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def __getstate__(self):
+        # string_index can be rebuilt from strings, so we do not pickle it
+        state = dict(self.__dict__)
+        del state['string_index']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.string_index = {s: i for (i, s) in enumerate(self.strings)}
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __iter__(self):
+        yield 'areas'
+        if self.filename is not None:
+            yield 'filename'
+
+    def __getitem__(self, key):
+        if key == 'areas':
+            return self.children('page', 0)
+        if key == 'filename' and self.filename is not None:
+            return self.filename
+        raise KeyError(key)
+
+    def children(self, parent, i):
+        """Views of the children of element i at level parent"""
+
+        level = levels[levels.index(parent) + 1] if parent != 'page' \
+            else 'area'
+        (start, end) = self.starts[parent][i:i + 2]
+        if level == 'word':
+            return [WordView(self, j) for j in range(start, end)]
+        return [ElementView(self, level, j) for j in range(start, end)]
+
+    @property
+    def nwords(self):
+        return len(self.words)
+
+    def membership(self, parent):
+        """The index of the parent element of each item at the next level"""
+
+        counts = np.diff(self.starts[parent])
+        return np.repeat(np.arange(len(counts)), counts)
+
+    @property
+    def line(self):
+        """The index of the line of each word"""
+        return self.membership('line')
+
+    @property
+    def par(self):
+        """The index of the paragraph of each word"""
+        return self.membership('par')[self.line]
+
+    @property
+    def area(self):
+        """The index of the area of each word"""
+        return self.membership('area')[self.par]
+
+    def word_strings(self):
+        """The text of each word, as a list"""
+
+        strings = self.strings
+        return [strings[i] for i in self.words.tolist()]
+
+    def text(self):
+        """Turn the page into plain text, as parse_hocr.ocr_page_to_text"""
+
+        words = self.word_strings()
+        wstarts = self.starts['line'].tolist()
+        lstarts = self.starts['par'].tolist()
+        text = ''
+        for p in range(len(lstarts) - 1):
+            for ln in range(lstarts[p], lstarts[p + 1]):
+                text += ' '.join(words[wstarts[ln]:wstarts[ln + 1]]) + '\n'
+            text += '\n'
+
+        # remove final extra newline
+        return text[:-1]
+
+
+class ElementView(Mapping):
+    """A dict-like view of an area, paragraph or line of an OCRPage"""
+
+    def __init__(self, page, level, i):
+        self.page = page
+        self.level = level
+        self.i = i
+
+    def __len__(self):
+        return 3
+
+    def __iter__(self):
+        return iter(['id', 'bbox', children[self.level]])
+
+    def __getitem__(self, key):
+        page = self.page
+        if key == 'id':
+            return page.strings[page.ids[self.level][self.i]]
+        if key == 'bbox':
+            return page.bboxes[self.level][self.i].tolist()
+        if key == children[self.level]:
+            return page.children(self.level, self.i)
+        raise KeyError(key)
+
+    def to_dict(self):
+        return {k: v if k != children[self.level] else
+                [x.to_dict() for x in v] for (k, v) in self.items()}
+
+
+class WordView(Mapping):
+    """A dict-like view of a word of an OCRPage
+
+    The word fields can be changed by assigning to them, and other keys
+    can be set too.
+    """
+
+    def __init__(self, page, i):
+        self.page = page
+        self.i = i
+
+    def keys_present(self):
+        page = self.page
+        keys = list(word_fields)
+        if page.correct is not None:
+            keys.append('correct')
+        if page.idused is not None and page.idused[self.i] >= 0:
+            keys.append('idused')
+        return keys + list(page.extras.get(self.i, {}))
+
+    def __len__(self):
+        return len(self.keys_present())
+
+    def __iter__(self):
+        return iter(self.keys_present())
+
+    def __getitem__(self, key):
+        page = self.page
+        i = self.i
+        if key == 'word':
+            return page.strings[page.words[i]]
+        if key == 'id':
+            return page.strings[page.ids['word'][i]]
+        if key == 'bbox':
+            return page.bboxes['word'][i].tolist()
+        if key in ('conf', 'dictconf', 'modconf'):
+            return int(getattr(page, key)[i])
+        if key == 'correct' and page.correct is not None:
+            return bool(page.correct[i])
+        if (key == 'idused' and page.idused is not None and
+                page.idused[i] >= 0):
+            return page.strings[page.idused[i]]
+        return page.extras[i][key]
+
+    def __setitem__(self, key, value):
+        page = self.page
+        i = self.i
+        if key == 'word':
+            page.words[i] = page.intern(value)
+        elif key == 'id':
+            page.ids['word'][i] = page.intern(value)
+        elif key == 'bbox':
+            page.bboxes['word'][i] = value
+        elif key in ('conf', 'dictconf', 'modconf'):
+            getattr(page, key)[i] = value
+        elif key == 'correct':
+            if page.correct is None:
+                page.correct = np.zeros(page.nwords, dtype=bool)
+            page.correct[i] = value
+        elif key == 'idused':
+            if page.idused is None:
+                page.idused = np.full(page.nwords, -1, dtype=np.int32)
+            page.idused[i] = page.intern(value)
+        else:
+            page.extras.setdefault(i, {})[key] = value
+
+    def to_dict(self):
+        return dict(self.items())
@@ -9,8 +9,10 @@ and parses the hOCR file to produce a list of words identified.
 import sys
 import re
 import os
+import functools
 from html.parser import HTMLParser
 from lxml import etree
+import worddict
 
 # Magic constant: confidence penalty for a non-dictionary word
 nondictpenalty = 30
@@ -18,6 +20,13 @@ nondictpenalty = 30
 bbox_plain_re = re.compile(r'bbox (\d+) (\d+) (\d+) (\d+)')
 bbox_word_re = re.compile(r'bbox (\d+) (\d+) (\d+) (\d+); x_wconf (\d+)$')
 puncs = []
+punc_table = None
+punc_suffix_lens = None
+punc_prefix_max = 0
+word_re = re.compile(r'\w+')
+# How many of the most recent results of trimword to remember; the
+# same words occur many times on a page and across the scalings
+trimword_cache_size = 65536
 dictionary = set()
 datapath = os.path.dirname(os.path.abspath(__file__))
 
@@ -193,6 +202,37 @@ def calculate_modconf_75(conf):
         return int(1.6 * conf - 55)
 
 
+def load_dictionary():
+    """Load the dictionary used to determine dictconf
+
+    If the word list has been compiled with worddict.py, the index is
+    memory-mapped, and otherwise the word list is read into a set.
+    """
+
+    global dictionary
+    if not dictionary:
+        wordlist = os.path.join(datapath, 'british-english-large')
+        try:
+            dictionary = worddict.WordIndex(wordlist + '.index', wordlist)
+            return
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            print('Not using the dictionary index: %s' % err,
+                  file=sys.stderr)
+
+        dictionary = worddict.read_wordlist(wordlist)
+
+
+def calculate_modconf(conf, resolution):
+    if resolution == 60:
+        return calculate_modconf_60(conf)
+    elif resolution == 75:
+        return calculate_modconf_75(conf)
+    else:
+        return conf
+
+
 def tidy_ocr_page(page, resolution=60, tag_ids=False, tag_id=None):
     """Take output from process_etree, and make a copy with whitespace removed
 
@@ -228,9 +268,7 @@ def tidy_ocr_page(page, resolution=60, tag_ids=False, tag_id=None):
     though it would be easy to do so.  To do this,
     """
 
-    if not dictionary:
-        for word in open(os.path.join(datapath, 'british-english-large')):
-            dictionary.add(word.strip().lower())
+    load_dictionary()
 
     page2 = page.copy()
     if 'filename' in page:
@@ -271,12 +309,8 @@ def tidy_ocr_page(page, resolution=60, tag_ids=False, tag_id=None):
                         else:
                             w2['dictconf'] = \
                                 max(w2['conf'] - nondictpenalty, 0)
-                        if resolution == 60:
-                            w2['modconf'] = calculate_modconf_60(w2['conf'])
-                        elif resolution == 75:
-                            w2['modconf'] = calculate_modconf_75(w2['conf'])
-                        else:
-                            w2['modconf'] = w2['conf']
+                        w2['modconf'] = calculate_modconf(w2['conf'],
+                                                          resolution)
                         ln2['words'].append(w2)
                 if len(ln2['words']) > 0:
                     p2['lines'].append(ln2)
@@ -288,31 +322,95 @@ def tidy_ocr_page(page, resolution=60, tag_ids=False, tag_id=None):
     return page2
 
 
-def trimword(w):
-    """Remove leading or trailing punctuation from a word, and lower() it
-
-    Sometimes words end in a full stop, for example, and then it won't
-    be found in the dictionary.  If we remove those, then we can be
-    more confident about whether we have a good word.
+def load_puncs():
+    """Load the punctuation patterns used by trimword
 
     Tesseract includes just what we need: eng.punc lists lots of known
     punctuation patterns, so we will use this.  Just a couple of small
     tweaks made to it to give our version (removing the punctuation-less
     initial entry, and removing the trailing spaces in the pattern
     '_!!!)__' where underscore indicates a trailing space).
+
+    Each pattern is some punctuation, a space standing for the word,
+    and some more punctuation.  They are compiled into regexes in
+    puncs, and also put into punc_table, which maps each prefix to a
+    dict mapping each suffix to the position of the first pattern with
+    that prefix and suffix.
+    """
+
+    global punc_table, punc_suffix_lens, punc_prefix_max
+    if punc_table is not None:
+        return
+
+    table = {}
+    for pat in open(os.path.join(datapath, 'eng.punc')):
+        # trailing spaces are significant in this file, so only
+        # strip newline characters
+        pat = pat.replace('\n', '')
+        if pat.count(' ') != 1 or 'X' in pat:
+            raise Exception('Unexpected pattern in eng.punc: "%s"' % pat)
+        (prefix, suffix) = pat.split(' ')
+        table.setdefault(prefix, {}).setdefault(suffix, len(puncs))
+        # for some reason, re.escape escapes spaces
+        pat = pat.replace(' ', 'X')
+        pat = re.escape(pat)
+        pat = pat.replace('X', r'(\w+)')
+        puncs.append(re.compile(pat + '$'))
+
+    punc_suffix_lens = {prefix: sorted(set(len(s) for s in suffixes))
+                        for (prefix, suffixes) in table.items()}
+    punc_prefix_max = max(len(prefix) for prefix in table)
+    punc_table = table
+
+
+def trimword(w):
+    """Remove leading or trailing punctuation from a word, and lower() it
+
+    Sometimes words end in a full stop, for example, and then it won't
+    be found in the dictionary.  If we remove those, then we can be
+    more confident about whether we have a good word.  The first
+    pattern in eng.punc (see load_puncs) which matches the word
+    determines what is removed.
     """
 
-    if not puncs:
-        for pat in open(os.path.join(datapath, 'eng.punc')):
-            # trailing spaces are significant in this file, so only
-            # strip newline characters
-            pat = pat.replace('\n', '')
-            # for some reason, re.escape escapes spaces
-            pat = pat.replace(' ', 'X')
-            pat = re.escape(pat)
-            pat = pat.replace('X', r'(\w+)')
-            puncs.append(re.compile(pat + '$'))
+    if punc_table is None:
+        load_puncs()
+    return trimword_cached(w)
+
+
+@functools.lru_cache(maxsize=trimword_cache_size)
+def trimword_cached(w):
+    # Rather than trying each of the patterns in turn, we look up the
+    # possible prefixes and suffixes of w in punc_table, and take the
+    # first pattern which fits with a word (\w+) between them.  As
+    # the patterns end with $, a final newline is ignored.
+    body = w[:-1] if w.endswith('\n') else w
+    best = None
+    for plen in range(min(punc_prefix_max, len(body)) + 1):
+        suffixes = punc_table.get(body[:plen])
+        if suffixes is None:
+            continue
+        for slen in punc_suffix_lens[body[:plen]]:
+            if plen + slen >= len(body):
+                break
+            pos = suffixes.get(body[len(body) - slen:])
+            if (pos is not None and (best is None or pos < best[0]) and
+                    word_re.fullmatch(body, plen, len(body) - slen)):
+                best = (pos, body[plen:len(body) - slen])
+    if best is not None:
+        return best[1].lower()
+
+    return w.lower()
+
 
+def trimword_ordered(w):
+    """trimword, trying each pattern in turn
+
+    This is much slower than trimword, but is how trimword used to
+    work, so is kept to check that trimword gives the same results.
+    """
+
+    load_puncs()
     for pat in puncs:
         m = pat.match(w)
         if m:
@@ -342,11 +440,13 @@ def ocr_page_to_text(page):
     return text[:-1]
 
 
-def parse_hocr_file(fn, resolution=60):
+def parse_hocr_file(fn, resolution=60, tag_id=None):
     """Parse an hOCR file, and return the parsed object if successful
 
     This function should be given the full pathname of the hOCR relative
-    to the current working directory or an absolute pathname.
+    to the current working directory or an absolute pathname.  The ids
+    in the tidied page are tagged with tag_id, or with fn if this is not
+    given.
     """
 
     raw_parsed = etree.parse(fn)
@@ -359,6 +459,285 @@ def parse_hocr_file(fn, resolution=60):
     # keep hold of the filename
     tree['filename'] = fn
 
-    tidied = tidy_ocr_page(tree, resolution=resolution, tag_ids=True)
+    tidied = tidy_ocr_page(tree, resolution=resolution, tag_ids=True,
+                           tag_id=tag_id)
 
     return tree, tidied
+
+
+line_classes = {'ocr_line', 'ocr_caption', 'ocr_textfloat', 'ocr_header'}
+
+
+class hOCRTarget:
+    """An lxml parser target which builds a tidied page as it goes
+
+    See iterparse_hocr.  The depth of an element is 1 for the root
+    <html>, 2 for <head> and <body>, 3 for the ocr_page, and 4 to 7 for
+    the areas, paragraphs, lines and words.  The words are by far the
+    most common elements, so they are dealt with first.
+    """
+
+    def __init__(self, resolution, prefix):
+        self.resolution = resolution
+        self.prefix = prefix
+        self.err = ''
+        self.page = {'areas': []}
+        self.area = self.par = self.line = self.word = None
+        self.depth = 0
+        # the number of <html> children seen, and whether we have seen
+        # the first child of the <body>
+        self.nroot = 0
+        self.inbody = False
+        self.seenpage = False
+        # the depth of the element whose contents we are ignoring
+        self.skip = None
+        self.inword = False
+        self.text = []
+
+    def start(self, tag, attrib):
+        self.depth = depth = self.depth + 1
+        if self.skip is not None:
+            return
+
+        if depth == 7:
+            # these should be ocrx_word spans
+            wclass = attrib.get('class')
+            if wclass != 'ocrx_word':
+                self.err += ('expected ocrx_word class, got %s, at id %s\n'
+                             % (wclass, attrib.get('id')))
+                self.skip = depth
+                return
+            wtitle = attrib.get('title')
+            m = bbox_word_re.match(wtitle)
+            if not m:
+                self.err += ('Failed to parse bbox and conf at id %s: '
+                             'Could not parse bbox data: %s\n'
+                             % (self.pid, wtitle))
+                self.skip = depth
+                return
+            self.word = {'id': self.prefix + attrib.get('id'),
+                         'bbox': [int(m.group(1)), int(m.group(2)),
+                                  int(m.group(3)), int(m.group(4))],
+                         'conf': int(m.group(5))}
+            self.inword = True
+            self.text = []
+        elif depth == 6:
+            # these should be ocr_line or ocr_caption or ocr_textfloat
+            # <span>s
+            lclass = attrib.get('class')
+            lid = attrib.get('id')
+            if lclass not in line_classes:
+                self.err += ('expected ocr_line class, got %s, at id %s\n'
+                             % (lclass, lid))
+                self.skip = depth
+                return
+            (bbox, berr) = parse_plain_bboxdata(attrib.get('title'))
+            if berr is not None:
+                self.err += ('Failed to parse bbox at id %s: %s'
+                             % (self.pid, berr))
+                self.skip = depth
+                return
+            self.line = {'id': self.prefix + lid, 'bbox': bbox, 'words': []}
+        elif depth == 5:
+            # these should be ocr_par <p>s; process_etree takes their
+            # bboxes from the area, so we do too
+            pclass = attrib.get('class')
+            self.pid = pid = attrib.get('id')
+            if pclass != 'ocr_par':
+                self.err += ('expected ocr_par class, got %s, at id %s\n'
+                             % (pclass, pid))
+                self.skip = depth
+                return
+            (bbox, berr) = parse_plain_bboxdata(self.atitle)
+            self.par = {'id': self.prefix + pid, 'bbox': bbox, 'lines': []}
+        elif depth == 4:
+            # these should be ocr_carea divs
+            aclass = attrib.get('class')
+            aid = attrib.get('id')
+            if aclass != 'ocr_carea':
+                self.err += ('expected ocr_carea class, got %s, at id %s\n'
+                             % (aclass, aid))
+                self.skip = depth
+                return
+            self.atitle = attrib.get('title')
+            (bbox, berr) = parse_plain_bboxdata(self.atitle)
+            if berr is not None:
+                self.err += ('Failed to parse bbox at id %s: %s'
+                             % (aid, berr))
+                self.skip = depth
+                return
+            self.area = {'id': self.prefix + aid, 'bbox': bbox, 'pars': []}
+        elif depth == 3:
+            # body[0] should be the ocr_page
+            if not self.inbody or self.seenpage:
+                self.skip = depth
+            elif attrib.get('class') != 'ocr_page':
+                self.err = 'body[0] is not an ocr_page div\n'
+                # ignore everything else
+                self.skip = 0
+            self.seenpage = True
+        elif depth == 2:
+            # root[1] is the <body>
+            self.inbody = self.nroot == 1
+            self.nroot += 1
+            if not self.inbody:
+                self.skip = depth
+
+    def end(self, tag):
+        depth = self.depth
+        self.depth -= 1
+        if self.skip is not None:
+            if depth == self.skip:
+                self.skip = None
+        elif depth == 7:
+            self.inword = False
+            wd = ''.join(self.text).strip()
+            if wd != '':
+                word = self.word
+                conf = word['conf']
+                word['word'] = wd
+                if trimword(wd) in dictionary:
+                    word['dictconf'] = conf
+                else:
+                    word['dictconf'] = max(conf - nondictpenalty, 0)
+                word['modconf'] = calculate_modconf(conf, self.resolution)
+                self.line['words'].append(word)
+        elif depth == 6:
+            if self.line['words']:
+                self.par['lines'].append(self.line)
+        elif depth == 5:
+            if self.par['lines']:
+                self.area['pars'].append(self.par)
+        elif depth == 4:
+            if self.area['pars']:
+                self.page['areas'].append(self.area)
+
+    def data(self, data):
+        if self.inword:
+            self.text.append(data)
+
+    def close(self):
+        return (self.page, self.err)
+
+
+def iterparse_hocr(fn, resolution=60, tag_id=None):
+    """Parse an hOCR file straight into a tidied page in a single pass
+
+    This produces the same page as parse_hocr_file does (with the ids
+    tagged with tag_id, or with fn if this is not given), and the same
+    errors as process_etree, but without building the whole lxml tree,
+    the untidied page and then the tidied copy of it: the file is read
+    by lxml's parser with an hOCRTarget, which tidies each word as soon
+    as it has been read, and no elements are made at all.
+
+    Returns (page, err), as process_etree does.
+    """
+
+    load_dictionary()
+    if tag_id is None:
+        tag_id = fn
+
+    target = hOCRTarget(resolution, tag_id + '+')
+    (page, err) = etree.parse(fn, etree.XMLParser(target=target))
+    page['filename'] = fn
+    return (page, err)
+
+
+def read_hocr_file(fn, resolution=60, tag_id=None):
+    """Parse an hOCR file, and return the tidied page
+
+    This is the same as the tidied page returned by parse_hocr_file,
+    but is produced much more quickly using iterparse_hocr.
+    """
+
+    (page, err) = iterparse_hocr(fn, resolution=resolution, tag_id=tag_id)
+
+    if err != '':
+        print('There were some parsing errors - expect problems ahead:\n%s' %
+              err, file=sys.stderr)
+
+    return page
+
+
+if __name__ == '__main__':
+    # Benchmark read_hocr_file against parse_hocr_file
+    import time
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(
+        description='Time reading hOCR files with read_hocr_file and '
+                    'parse_hocr_file, and check that the results agree')
+    arg_parser.add_argument('-r', '--resolution', type=int, default=60,
+                            help='Resolution of the images (default 60)')
+    arg_parser.add_argument('-n', '--repeat', type=int, default=5,
+                            help='Number of times to read each file '
+                                 '(default 5)')
+    arg_parser.add_argument('--check-trimword', action='store_true',
+                            help='Check that trimword gives the same results '
+                                 'as trimword_ordered for the dictionary '
+                                 'words and the words in the hOCR files')
+    arg_parser.add_argument('hocr', nargs='*', help='hOCR files to read')
+    args = arg_parser.parse_args()
+
+    load_dictionary()
+    trimword('')
+
+    if args.check_trimword:
+        import random
+
+        wordlist = os.path.join(datapath, 'british-english-large')
+        words = [w.replace('\n', '') for w in open(wordlist)]
+        for fn in args.hocr:
+            page = read_hocr_file(fn, args.resolution)
+            words.extend(w['word'] for a in page['areas'] for p in a['pars']
+                         for ln in p['lines'] for w in ln['words'])
+        # and some words with (possibly several lots of) punctuation
+        rng = random.Random(0)
+        pats = [pat.replace('\n', '').split(' ')
+                for pat in open(os.path.join(datapath, 'eng.punc'))]
+        cores = words[:1000] + ['', 'a', '1', '_', "it's", 'a.b', 'x\n']
+        for i in range(200000):
+            w = rng.choice(cores)
+            for j in range(rng.choice([1, 1, 1, 2, 3])):
+                (prefix, suffix) = rng.choice(pats)
+                w = prefix + w + suffix
+            words.append(w + rng.choice(['', '', '', '\n', '\n\n', ' ']))
+
+        start = time.perf_counter()
+        ordered = [trimword_ordered(w) for w in words]
+        ordered_time = time.perf_counter() - start
+        trimword_cached.cache_clear()
+        start = time.perf_counter()
+        trimmed = [trimword(w) for w in words]
+        trimword_time = time.perf_counter() - start
+        differ = [w for (w, t1, t2) in zip(words, ordered, trimmed)
+                  if t1 != t2]
+        print('trimword: %d words; trimword_ordered %.2fs, trimword %.2fs '
+              '(%.1fx); %d differ%s' %
+              (len(words), ordered_time, trimword_time,
+               ordered_time / trimword_time, len(differ),
+               ''.join('\n  %r' % w for w in differ[:10])))
+        if differ:
+            sys.exit(1)
+    totals = [0, 0]
+    for fn in args.hocr:
+        times = []
+        for parse in [lambda: parse_hocr_file(fn, args.resolution)[1],
+                      lambda: read_hocr_file(fn, args.resolution)]:
+            start = time.perf_counter()
+            for i in range(args.repeat):
+                page = parse()
+            times.append((time.perf_counter() - start) / args.repeat)
+            if len(times) == 1:
+                oldpage = page
+        nwords = sum(len(ln['words']) for a in page['areas']
+                     for p in a['pars'] for ln in p['lines'])
+        print('%s: %d words; parse_hocr_file %.4fs, read_hocr_file %.4fs '
+              '(%.1fx)%s' % (fn, nwords, times[0], times[1],
+                             times[0] / times[1],
+                             '' if page == oldpage else '; RESULTS DIFFER'))
+        totals[0] += times[0]
+        totals[1] += times[1]
+    if len(args.hocr) > 1:
+        print('total: parse_hocr_file %.4fs, read_hocr_file %.4fs (%.1fx)' %
+              (totals[0], totals[1], totals[0] / totals[1]))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+An on-disk cache of high-resolution renderings of lines of text
+
+Rendering a line with LuaLaTeX is by far the slowest part of making
+training images, and the same (text, font, fontsize, rotation, res,
+border) combination is rendered again whenever the training images are
+rebuilt with a different resolution, noise or exposure, or when a line
+appears more than once in the training text.  This cache stores the
+cropped hi-res images as PNG files named by a hash of those parameters
+and the LaTeX preamble, so that only new lines need to be rendered.
+
+The cache directory can be shared between concurrent processes: files
+are written atomically, a file vanishing under our feet is treated as a
+cache miss, and only one process at a time evicts entries.  When the
+total size of the cache exceeds its cap, the least recently used
+entries are removed; a cache hit updates the modification time of the
+entry, which is what we use to determine the least recently used ones.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import fcntl
+import textimages
+from PIL import Image
+
+
+class HiresCache:
+    def __init__(self, cachedir, maxsize=10 * 1024 ** 3,
+                 renderer='lualatex'):
+        """Use (and if necessary create) the cache in cachedir
+
+        maxsize is the maximum total size of the cached images in bytes.
+        renderer is one of the renderers in textimages.renderers; the
+        renderings from different renderers are cached separately.
+        """
+
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.renderer = renderer
+        os.makedirs(cachedir, exist_ok=True)
+        self.lockfile = os.path.join(cachedir, 'evict.lock')
+        # Our estimate of the total size of the cache; this does not
+        # include entries added by other processes, so we also rescan
+        # the cache every so often.  The first scan is only done on the
+        # first put, as scanning a large cache takes a while, and there
+        # may be a cache in each of many worker processes which never
+        # add anything to it.
+        self.totalsize = 0
+        self.puts = 0
+        self.rescan_every = 1000
+
+    def key(self, text, font, fontsize, rotation, res, border):
+        """Determine the hash key for a rendering"""
+
+        params = [text.strip(), font, float(fontsize), float(rotation),
+                  res, border]
+        if self.renderer == 'lualatex':
+            params += [textimages.ltx_preamble, textimages.ltx_font]
+        else:
+            params.append(self.renderer)
+        return hashlib.sha256(json.dumps(params).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key[:2], key + '.png')
+
+    def get(self, key):
+        """Return the cached image for key as a PIL Image, or None"""
+
+        path = self.path(key)
+        try:
+            im = Image.open(path)
+            im.load()
+        except OSError:
+            # either not there or removed while we were reading it
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return im
+
+    def put(self, key, im):
+        """Store the PIL Image im in the cache under key"""
+
+        path = self.path(key)
+        keydir = os.path.dirname(path)
+        os.makedirs(keydir, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=keydir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmpfile:
+                im.save(tmpfile, format='PNG')
+            os.replace(tmppath, path)
+        except Exception:
+            os.remove(tmppath)
+            raise
+
+        self.totalsize += os.path.getsize(path)
+        self.puts += 1
+        if (self.totalsize > self.maxsize or
+                (self.puts - 1) % self.rescan_every == 0):
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries if the cache is too big
+
+        This also recalculates our estimate of the total cache size.
+        The cache is reduced to 90% of its maximum size, so that we do
+        not have to evict on every subsequent put.
+        """
+
+        with open(self.lockfile, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # someone else is already doing this
+                return
+
+            entries = []
+            for dirpath, dirnames, filenames in os.walk(self.cachedir):
+                for fn in filenames:
+                    if not fn.endswith('.png'):
+                        continue
+                    path = os.path.join(dirpath, fn)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+
+            total = sum(entry[1] for entry in entries)
+            if total > self.maxsize:
+                entries.sort()
+                for (mtime, size, path) in entries:
+                    if total <= 0.9 * self.maxsize:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+
+            self.totalsize = total
+
+    def hires_from_text(self, text, font, fontsize=10, rotation=0,
+                        res=1200, border=12, debug=False):
+        """A cached version of textimages.hires_from_text
+
+        This uses the cache's renderer.
+        """
+
+        if text.strip() == '':
+            return None
+        key = self.key(text, font, fontsize, rotation, res, border)
+        im = self.get(key)
+        if im is None:
+            render = textimages.renderers[self.renderer]
+            im = render(text, font, fontsize=fontsize, rotation=rotation,
+                        res=res, border=border, debug=debug)
+            if im is not None:
+                self.put(key, im)
+        return im
+
+    def hires_from_text_batch(self, jobs, res=1200, border=12,
+                              debug=False, workers=1):
+        """A cached version of textimages.hires_from_text_batch
+
+        Only the jobs which are not in the cache are rendered, and
+        repeated jobs are only rendered once.  The rendering is done by
+        workers threads; the cache itself is only accessed from the
+        calling thread.
+        """
+
+        ims = [None] * len(jobs)
+        misses = {}
+        for i, (text, font, fontsize, rotation) in enumerate(jobs):
+            if text.strip() == '':
+                continue
+            key = self.key(text, font, fontsize, rotation, res, border)
+            if key in misses:
+                misses[key].append(i)
+                continue
+            ims[i] = self.get(key)
+            if ims[i] is None:
+                misses[key] = [i]
+
+        if misses:
+            keys = list(misses)
+            rendered = textimages.hires_from_text_batch(
+                [jobs[misses[key][0]] for key in keys],
+                res=res, border=border, debug=debug, renderer=self.renderer,
+                workers=workers)
+            for key, im in zip(keys, rendered):
+                if im is not None:
+                    self.put(key, im)
+                for i in misses[key]:
+                    ims[i] = im
+
+        return ims
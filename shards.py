@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Store training line files in indexed tar shards rather than loose files
+
+Each training line consists of several small files (.png, .gt.txt,
+.box), and with millions of lines, creating, copying and listing the
+individual files takes much longer than writing their contents.
+gen_tess_training_data.py can therefore instead write them into tar
+files holding a fixed number of lines each, named <base>-00000.tar,
+<base>-00001.tar and so on.
+
+Next to each shard is an index <shard>.idx, with one JSON record per
+line, such as:
+
+    {"id": "aaa_Times_New_Roman_023",
+     "files": {".png": [1536, 1041], ".gt.txt": [3584, 21],
+               ".box": [4608, 190]}}
+
+giving the offset and size of the contents of each of the line's files
+within the shard.  The files are written to the shard before the index
+record, so if the process crashes, any line in the index is complete
+(and a partial final index record is ignored).  The shards are ordinary
+tar files (although one left by a crash lacks the end-of-archive
+marker), so they can also be unpacked with tar.
+
+ShardReader gives random access to the lines by id, and running this
+file as a script extracts the loose files, which tesseract needs, from
+the shards in a directory.
+"""
+
+import os
+import io
+import glob
+import json
+import tarfile
+import argparse
+from PIL import Image
+
+
+def shard_name(base, shardnum):
+    return '%s-%05d.tar' % (base, shardnum)
+
+
+def read_index(idxpath):
+    """Generate the complete records in a shard index"""
+
+    with open(idxpath, 'rb') as idx:
+        for rawline in idx:
+            if not rawline.endswith(b'\n'):
+                # a partial record left by a crash
+                break
+            yield json.loads(rawline)
+
+
+class ShardWriter:
+    def __init__(self, outdir, base, shard_size, first_shard=0):
+        """Write lines to shards in outdir named after base
+
+        Each shard holds shard_size lines.  The shards are numbered from
+        first_shard; when adding to an existing directory, next_shard
+        gives the number to use.
+        """
+
+        self.outdir = outdir
+        self.base = base
+        self.shard_size = shard_size
+        self.shardnum = first_shard
+        self.tar = None
+        self.idx = None
+        self.count = 0
+
+    @staticmethod
+    def next_shard(outdir, base):
+        """The number of the first unused shard for base in outdir"""
+
+        shards = glob.glob(os.path.join(outdir, glob.escape(base) +
+                                        '-[0-9][0-9][0-9][0-9][0-9].tar'))
+        if not shards:
+            return 0
+        return max(int(s[-9:-4]) for s in shards) + 1
+
+    def open_shard(self):
+        self.name = shard_name(self.base, self.shardnum)
+        path = os.path.join(self.outdir, self.name)
+        self.tar = tarfile.open(path, 'w', format=tarfile.GNU_FORMAT)
+        self.idx = open(path + '.idx', 'w')
+        self.count = 0
+
+    def add(self, lineid, files):
+        """Add a line to the current shard
+
+        files is a dict mapping each file extension (such as '.png') to
+        the contents of the file as bytes.  Returns the name of the
+        shard that the line was written to.
+        """
+
+        if self.tar is None:
+            self.open_shard()
+
+        offsets = {}
+        for ext, data in files.items():
+            info = tarfile.TarInfo(lineid + ext)
+            info.size = len(data)
+            info.mtime = 0
+            info.mode = 0o644
+            header = info.tobuf(self.tar.format, self.tar.encoding,
+                                self.tar.errors)
+            offsets[ext] = [self.tar.offset + len(header), len(data)]
+            self.tar.addfile(info, io.BytesIO(data))
+        self.tar.fileobj.flush()
+
+        print(json.dumps({'id': lineid, 'files': offsets},
+                         ensure_ascii=False), file=self.idx, flush=True)
+
+        name = self.name
+        self.count += 1
+        if self.count >= self.shard_size:
+            self.close()
+            self.shardnum += 1
+        return name
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.idx.close()
+            self.tar = None
+            self.idx = None
+
+
+class ShardReader:
+    def __init__(self, shardsdir, base=None):
+        """Read the shards in shardsdir (only those named after base, if given)
+
+        If a line appears in more than one shard (which can happen if
+        the generation was interrupted and resumed), the one in the
+        later shard is used.
+        """
+
+        self.shardsdir = shardsdir
+        if base is None:
+            pattern = '*.tar.idx'
+        else:
+            pattern = glob.escape(base) + '-[0-9][0-9][0-9][0-9][0-9].tar.idx'
+        self.lines = {}
+        for idxpath in sorted(glob.glob(os.path.join(shardsdir, pattern))):
+            shard = os.path.basename(idxpath)[:-len('.idx')]
+            for record in read_index(idxpath):
+                self.lines[record['id']] = (shard, record['files'])
+        self.handles = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles = {}
+
+    def ids(self):
+        """The ids of all of the lines, in the order they were written"""
+
+        return list(self.lines)
+
+    def __contains__(self, lineid):
+        return lineid in self.lines
+
+    def __len__(self):
+        return len(self.lines)
+
+    def extensions(self, lineid):
+        return list(self.lines[lineid][1])
+
+    def read(self, lineid, ext):
+        """Return the contents of the file lineid + ext as bytes"""
+
+        shard, files = self.lines[lineid]
+        offset, size = files[ext]
+        if shard not in self.handles:
+            self.handles[shard] = open(os.path.join(self.shardsdir, shard),
+                                       'rb')
+        handle = self.handles[shard]
+        handle.seek(offset)
+        return handle.read(size)
+
+    def image(self, lineid):
+        """Return the line image as a PIL Image"""
+
+        im = Image.open(io.BytesIO(self.read(lineid, '.png')))
+        im.load()
+        return im
+
+    def text(self, lineid):
+        """Return the ground truth text of the line"""
+
+        return self.read(lineid, '.gt.txt').decode('utf-8').rstrip('\n')
+
+    def extract(self, destdir, lineids=None, exts=None):
+        """Write the files for the given lines (default all) into destdir
+
+        exts restricts the files written to the given extensions.
+        Returns the number of lines extracted.
+        """
+
+        if lineids is None:
+            lineids = self.lines
+        os.makedirs(destdir, exist_ok=True)
+        count = 0
+        for lineid in lineids:
+            for ext in self.lines[lineid][1]:
+                if exts is not None and ext not in exts:
+                    continue
+                with open(os.path.join(destdir, lineid + ext), 'wb') as f:
+                    f.write(self.read(lineid, ext))
+            count += 1
+        return count
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Extract loose training line files from shards')
+
+    arg_parser.add_argument('shardsdir', metavar='SHARDSDIR',
+                            help='Directory containing the shards')
+    arg_parser.add_argument('destdir', metavar='DESTDIR',
+                            help='Directory in which to write the files')
+    arg_parser.add_argument('--base', metavar='BASENAME',
+                            help='Only read the shards named after BASENAME')
+    arg_parser.add_argument('--ids', metavar='FILE',
+                            help='File listing the ids of the lines to '
+                                 'extract, one per line (default: all)')
+    arg_parser.add_argument('--exts', metavar='EXTS',
+                            help='Comma-separated list of the file '
+                                 'extensions to extract, such as .png,.box '
+                                 '(default: all)')
+
+    args = arg_parser.parse_args()
+
+    if args.ids:
+        with open(args.ids) as f:
+            lineids = [line.strip() for line in f if line.strip()]
+    else:
+        lineids = None
+    if args.exts:
+        exts = args.exts.split(',')
+    else:
+        exts = None
+
+    with ShardReader(args.shardsdir, base=args.base) as reader:
+        reader.extract(args.destdir, lineids=lineids, exts=exts)
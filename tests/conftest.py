@@ -0,0 +1,5 @@
+# The scripts being tested are in the directory above
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of make_lstmf.py, using a stand-in for the low resolution tesseract"""
+
+import os
+import sys
+import make_lstmf
+
+# Like tesseract, this makes one page per image in a list file, and
+# (like ReadAllBoxes) only uses the box lines of the Nth image whose
+# page field is N
+fake_tesseract = r'''
+import sys, struct
+inp, outbase = sys.argv[-3], sys.argv[-2]
+if inp.endswith('.png'):
+    images = [inp]
+else:
+    images = [line.strip() for line in open(inp) if line.strip()]
+def s(b):
+    return struct.pack('<i', len(b)) + b
+pages = []
+for (n, image) in enumerate(images):
+    boxes = [line.rsplit(' ', 5) for line in
+             open(image[:-4] + '.box', encoding='utf-8').read().split('\n')
+             if line and int(line.rsplit(' ', 1)[1]) == n]
+    if not boxes:
+        continue
+    text = ''.join(box[0] for box in boxes).encode()
+    pages.append(b'\x01' + s(image.encode()) + struct.pack('<i', n) +
+                 s(open(image, 'rb').read()) + s(b'eng') + s(text) +
+                 struct.pack('<i', len(boxes)) +
+                 b''.join(struct.pack('<4h', *map(int, box[1:5]))
+                          for box in boxes) +
+                 struct.pack('<i', len(boxes)) +
+                 b''.join(s(box[0].encode()) for box in boxes) + b'\x00')
+if pages:
+    with open(outbase + '.lstmf', 'wb') as f:
+        f.write(struct.pack('<i', len(pages)) + b''.join(pages))
+'''
+
+
+def make_images(tmp_path, n):
+    tessbin = tmp_path / 'tesseract'
+    tessbin.write_text('#!%s\n%s' % (sys.executable, fake_tesseract))
+    tessbin.chmod(0o755)
+    images = []
+    for i in range(n):
+        base = str(tmp_path / ('line_%03d' % i))
+        with open(base + '.png', 'wb') as f:
+            f.write(b'image %d' % i)
+        with open(base + '.box', 'w') as f:
+            f.write(''.join('%s 0 0 280 105 0\n' % c for c in 'ab%d' % i) +
+                    '\t 280 105 281 106 0\n')
+        images.append(base + '.png')
+    return (make_lstmf.tess_settings(tessbin=str(tessbin)), images)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_batch_matches_per_image(tmp_path):
+    (settings, images) = make_images(tmp_path, 5)
+
+    results = make_lstmf.process_batch(images, settings)
+    assert [r['image'] for r in results] == images
+    assert all(r['ok'] and r['batched'] for r in results)
+    batched = [read(image[:-4] + '.lstmf') for image in images]
+
+    for image in images:
+        assert make_lstmf.process_one([image], settings)[0]['ok']
+    assert [read(image[:-4] + '.lstmf') for image in images] == batched
+
+
+def test_missing_box(tmp_path):
+    (settings, images) = make_images(tmp_path, 3)
+    os.remove(images[1][:-4] + '.box')
+
+    assert not make_lstmf.is_done(images[1])
+    results = make_lstmf.process_batch(images, settings)
+    assert [r['ok'] for r in results] == [True, False, True]
+    assert results[0]['batched'] and results[2]['batched']
+    assert make_lstmf.is_done(images[0])
+    assert not make_lstmf.is_done(images[1])
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the ocr_images.py command line, using the stub OCR backend"""
+
+import os
+import sys
+import subprocess
+from PIL import Image
+
+ocr_images = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'ocr_images.py')
+
+
+def test_outbase_and_ground_truth(tmp_path):
+    Image.new('L', (1200, 300), 255).save(tmp_path / 'img.png')
+    (tmp_path / 'truth.txt').write_text('Canned stub output.\n')
+
+    subprocess.run([sys.executable, ocr_images, '--backend', 'stub',
+                    '--tessdata-path', str(tmp_path), '-s', 'C0,B0',
+                    '--outbase', 'myout', '-g', 'truth.txt', 'img.png'],
+                   cwd=tmp_path, check=True)
+
+    outputs = sorted(os.listdir(tmp_path))
+    assert not [fn for fn in outputs if fn.startswith('img-')]
+    for fn in ['myout-C0.hocr', 'myout-B0.hocr', 'myout-merged-C0B0.hocr',
+               'myout-merged-C0B0.txt', 'myout-merged-C0B0.metrics',
+               'myout-merged-C0B0.csv']:
+        assert fn in outputs
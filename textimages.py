@@ -5,18 +5,121 @@
 Functions to create a lower-resolution image from a higher one
 
 This module can also create a high-resolution image from text,
-assuming that LuaLaTeX can cope with it.  It can create greyscale
-or binary (black and white) images.
+assuming that LuaLaTeX can cope with it, or alternatively using
+FreeType through Pillow.  It can create greyscale or binary (black
+and white) images.
 """
 
+import sys
 import random
 import subprocess
 import os
 import math
-import warnings
+import itertools
+import re
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont
+
+
+# The LaTeX preamble used for rendering lines of text; the
+# document class line comes before this
+ltx_preamble = r"""\usepackage{fontspec}
+\usepackage{verbatim}
+\makeatletter
+\def\verbatim@font{}
+\makeatother
+\usepackage{graphicx}
+\usepackage{cprotect}
+"""
+
+ltx_font = r"""\setmainfont{%s}
+\fontsize{%fpt}{%fpt}\selectfont
+"""
+
+# The header of a binary PGM file: width, height, maxval
+pgm_header_re = re.compile(rb'P5\s+(\d+)\s+(\d+)\s+(\d+)\s')
+
+
+def verb_text(text):
+    """Wrap a (stripped) line of text in a \\verb command"""
+
+    for delim in '+-=^|"~?:#&':
+        if delim not in text:
+            return r'\verb%s%s%s' % (delim, text, delim)
+
+    raise Exception('cannot typeset this text; too many funny chars: '
+                    '%s' % text)
+
+
+def tex_env():
+    """The environment in which to run lualatex and pdftoppm
+
+    We make a copy of the environment rather than modifying os.environ,
+    so that this can be used from multiple threads.
+    """
+
+    env = dict(os.environ)
+    env['PATH'] = env.get('PATH', '') + ':/Library/TeX/texbin:/opt/local/bin'
+    return env
+
+
+def parse_pgms(data):
+    """Decode one or more concatenated binary 8-bit PGM images
+
+    This is the format written by pdftoppm -gray to stdout.  Returns a
+    list of 2-d uint8 arrays; these are read-only views into data rather
+    than copies.  We do this directly rather than using PIL, as PIL
+    warns about very large images (which we expect at high resolutions),
+    and suppressing that warning would not be thread-safe.
+    """
+
+    arrays = []
+    pos = 0
+    while pos < len(data):
+        m = pgm_header_re.match(data, pos)
+        if not m or int(m.group(3)) != 255:
+            raise Exception('cannot decode PGM data from pdftoppm')
+        (cols, rows) = (int(m.group(1)), int(m.group(2)))
+        arrays.append(np.frombuffer(data, dtype=np.uint8, count=rows * cols,
+                                    offset=m.end()).reshape(rows, cols))
+        pos = m.end() + rows * cols
+        # skip any whitespace between images
+        while pos < len(data) and data[pos:pos + 1].isspace():
+            pos += 1
+
+    return arrays
+
+
+def tex_to_arrays(texsrc, basename, res, workdir, multi=False):
+    """Typeset a document with lualatex and rasterise it with pdftoppm
+
+    The document texsrc is written to basename.tex in workdir, and
+    lualatex is run in that directory.  If multi is True, then every
+    page is rasterised, otherwise just the first page.  The rasterised
+    pages are read from pdftoppm's standard output, so are never
+    written to disk.
+
+    Returns a list of 2-d uint8 arrays, one per page.
+    """
+
+    env = tex_env()
+    with open(os.path.join(workdir, basename + '.tex'), 'w') as outtex:
+        print(texsrc, end='', file=outtex)
+
+    subprocess.run(['lualatex', '--interaction=batchmode',
+                    basename + '.tex'],
+                   check=True, capture_output=True, cwd=workdir, env=env)
+
+    cmd = ['pdftoppm', '-gray', '-r', str(res)]
+    if not multi:
+        cmd += ['-singlefile']
+    result = subprocess.run(cmd + [basename + '.pdf'],
+                            check=True, capture_output=True, cwd=workdir,
+                            env=env)
+
+    return parse_pgms(result.stdout)
 
 
 def hires_from_text(text, font, fontsize=10, rotation=0,
@@ -29,125 +132,287 @@ def hires_from_text(text, font, fontsize=10, rotation=0,
 
     If debug is set to True, the this function will use the
     current working directory and won't clean up afterwards.
+    Otherwise, all of the work is done in a temporary directory and
+    no global state is changed, so this function can be called from
+    multiple threads at once.
 
     Returns the word image as a PIL Image.
     """
 
-    saveenv = os.environ['PATH']
-    os.environ['PATH'] += ':/Library/TeX/texbin:/opt/local/bin'
+    text = text.strip()
+    if text == '':
+        return None
+    vtext = verb_text(text)
+
+    borderpt = (border / res) * 72.27
+    texsrc = (r'\documentclass[border=%.5fpt]{standalone}' % borderpt +
+              '\n' + ltx_preamble + '\\begin{document}\n' +
+              ltx_font % (font, fontsize, fontsize))
+    if rotation != 0:
+        texsrc += r'\newbox\hiresbox' + '\n'
+        texsrc += r'\cprotect[mm]\setbox\hiresbox\hbox{%s}' % vtext + '\n'
+        texsrc += r'\rotatebox{%f}{\usebox\hiresbox}' % rotation + '\n'
+    else:
+        texsrc += vtext + '\n'
+    texsrc += r'\end{document}' + '\n'
+
+    if debug:
+        arrays = tex_to_arrays(texsrc, 'hires-line', res, os.getcwd())
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            arrays = tex_to_arrays(texsrc, 'hires-line', res, workdir)
+
+    return crop_hires(arrays[0], border)
 
-    curdir = os.getcwd()
-    if not debug:
-        tempdir = tempfile.TemporaryDirectory()
-        os.chdir(tempdir.name)
 
+def hires_from_texts(texts, font, fontsize=10, rotations=None,
+                     res=1200, border=12, debug=False):
+    """Generate high-res images of many lines of text in one go.
+
+    This is equivalent to calling hires_from_text on each of the texts
+    with the same font, font size, resolution and border, but all of
+    the lines are typeset as one multi-page standalone document (one
+    line per page) with a single run of lualatex, and rasterised with
+    a single run of pdftoppm.  rotations, if given, is a list of angles
+    of rotation, one per text.
+
+    As with hires_from_text, this can be called from multiple threads
+    at once unless debug is True.
+
+    Returns a list of PIL Images, with None for each empty text (or
+    text which produces no ink).
+    """
+
+    if rotations is None:
+        rotations = [0] * len(texts)
+    texts = [text.strip() for text in texts]
+    # This will raise an exception if any of the texts cannot be typeset
+    vtexts = [verb_text(text) for text in texts if text != '']
+    if not vtexts:
+        return [None] * len(texts)
+
+    # Each hiresline environment becomes a separate page, cropped
+    # in the same way as a single-page standalone document
     borderpt = (border / res) * 72.27
-    with open('hires-line.tex', 'w') as outtex:
-        ltx_pre = r"""\documentclass[border=%.5fpt]{standalone}
-\usepackage{fontspec}
-\usepackage{verbatim}
-\makeatletter
-\def\verbatim@font{}
-\makeatother
-\usepackage{graphicx}
-\usepackage{cprotect}
-\begin{document}
-\setmainfont{%s}
-\fontsize{%fpt}{%fpt}\selectfont
-""" % (borderpt, font, fontsize, fontsize)
+    texsrc = (r'\documentclass[border=%.5fpt,multi]{standalone}'
+              % borderpt + '\n' + ltx_preamble +
+              '\\newenvironment{hiresline}{}{}\n' +
+              '\\standaloneenv{hiresline}\n' +
+              '\\newbox\\hiresbox\n' +
+              '\\begin{document}\n' +
+              ltx_font % (font, fontsize, fontsize))
+
+    vtextiter = iter(vtexts)
+    for text, rotation in zip(texts, rotations):
+        if text == '':
+            continue
+        vtext = next(vtextiter)
+        texsrc += r'\begin{hiresline}' + '\n'
+        if rotation != 0:
+            texsrc += (r'\cprotect[mm]\setbox\hiresbox\hbox{%s}' % vtext +
+                       '\n')
+            texsrc += r'\rotatebox{%f}{\usebox\hiresbox}' % rotation + '\n'
+        else:
+            texsrc += vtext + '\n'
+        texsrc += r'\end{hiresline}' + '\n'
+    texsrc += r'\end{document}' + '\n'
+
+    if debug:
+        arrays = tex_to_arrays(texsrc, 'hires-lines', res, os.getcwd(),
+                               multi=True)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            arrays = tex_to_arrays(texsrc, 'hires-lines', res, workdir,
+                                   multi=True)
 
-        print(ltx_pre, end='', file=outtex)
+    if len(arrays) != len(vtexts):
+        raise Exception('expected %d pages from lualatex, got %d'
+                        % (len(vtexts), len(arrays)))
 
-        text = text.strip()
+    ims = []
+    arrayiter = iter(arrays)
+    for text in texts:
         if text == '':
-            os.chdir(curdir)
-            os.environ['PATH'] = saveenv
-            return None
-
-        for delim in '+-=^|"~?:#&':
-            if delim not in text:
-                vtext = r'\verb%s%s%s' % (delim, text, delim)
-                break
+            ims.append(None)
         else:
-            os.chdir(curdir)
-            os.environ['PATH'] = saveenv
-            raise Exception('cannot typeset this text; too many funny chars: '
-                            '%s' % text)
+            ims.append(crop_hires(next(arrayiter), border))
 
-        if rotation != 0:
-            print(r'\newbox\hiresbox', file=outtex)
-            print(r'\cprotect[mm]\setbox\hiresbox\hbox{%s}' % vtext,
-                  file=outtex)
-            print(r'\rotatebox{%f}{\usebox\hiresbox}' % rotation,
-                  file=outtex)
+    return ims
+
+
+def hires_from_text_batch(jobs, res=1200, border=12, debug=False,
+                          renderer='lualatex', workers=1):
+    """Generate high-res images of a list of lines of text.
+
+    Each job is a tuple (text, font, fontsize, rotation).  With the
+    lualatex renderer, the jobs are grouped by font and font size, and
+    each group is rendered with a single call to hires_from_texts; with
+    any other renderer (see renderers below), the jobs are rendered one
+    at a time.
+
+    If workers is greater than 1, the rendering is done by a pool of
+    that many threads.  For the lualatex renderer, the groups are then
+    split into chunks of at most len(jobs) / workers lines, so that all
+    of the threads have something to do.  (The threads spend almost all
+    of their time waiting for lualatex, so this keeps that many cores
+    busy.)  debug should not be used with more than one worker, as the
+    workers would then all write to the same files.
+
+    Returns a list of PIL Images in the same order as the jobs, with
+    None for each empty text.
+    """
+
+    if renderer != 'lualatex':
+        render = renderers[renderer]
+
+        def render_job(job):
+            (text, font, fontsize, rotation) = job
+            return render(text, font, fontsize=fontsize, rotation=rotation,
+                          res=res, border=border, debug=debug)
+
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(render_job, jobs))
+        return [render_job(job) for job in jobs]
+
+    groups = {}
+    for i, (text, font, fontsize, rotation) in enumerate(jobs):
+        groups.setdefault((font, fontsize), []).append(i)
+
+    chunks = []
+    maxchunk = max(1, math.ceil(len(jobs) / workers))
+    for (font, fontsize), idxs in groups.items():
+        for c in range(0, len(idxs), maxchunk):
+            chunks.append((font, fontsize, idxs[c:c + maxchunk]))
+
+    def render_chunk(chunk):
+        (font, fontsize, idxs) = chunk
+        return hires_from_texts([jobs[i][0] for i in idxs], font,
+                                fontsize=fontsize,
+                                rotations=[jobs[i][3] for i in idxs],
+                                res=res, border=border, debug=debug)
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            chunkims = list(executor.map(render_chunk, chunks))
+    else:
+        chunkims = [render_chunk(chunk) for chunk in chunks]
+
+    ims = [None] * len(jobs)
+    for (font, fontsize, idxs), groupims in zip(chunks, chunkims):
+        for i, im in zip(idxs, groupims):
+            ims[i] = im
+
+    return ims
+
+
+# Font files found by find_font_file and fonts loaded by
+# hires_from_text_freetype
+fontfiles = {}
+ftfonts = {}
+
+
+def find_font_file(font):
+    """Find the font file for a font name, as used by fontspec
+
+    If font is the name of an existing file, that is used directly;
+    otherwise we ask fontconfig.  fontconfig always finds some font, so
+    we warn if it does not seem to be the one asked for.
+    """
+
+    if font not in fontfiles:
+        if os.path.isfile(font):
+            fontfiles[font] = font
         else:
-            print(vtext, file=outtex)
-
-        print(r'\end{document}', file=outtex)
-
-    try:
-        subprocess.run(['lualatex', '--interaction=batchmode',
-                        'hires-line.tex'],
-                       check=True, capture_output=True)
-    except Exception:
-        os.chdir(curdir)
-        os.environ['PATH'] = saveenv
-        raise
-
-    try:
-        subprocess.run(['pdftoppm', '-gray', '-r', str(res),
-                        '-singlefile', 'hires-line.pdf', 'hires-line'],
-                       check=True, capture_output=True)
-    except Exception:
-        os.chdir(curdir)
-        os.environ['PATH'] = saveenv
-        raise
-
-    warnings.simplefilter('ignore', Image.DecompressionBombWarning)
-    im = Image.open('hires-line.pgm')
-    # Unfortunately, this image may have too much white space
-    # around it, as the box may be larger than the actual text.
-    # So we manually remove the requisite number of blank white
-    # rows and columns.
-    imarrayfull = np.asarray(im, dtype=np.uint8)
-    imarrayinv = 255 - imarrayfull
-    imcsum = np.sum(imarrayinv, axis=0)
-    imrsum = np.sum(imarrayinv, axis=1)
-    rfirst = cfirst = 0
-    rows, cols = imarrayinv.shape
-    for i in range(rows):
-        if imrsum[i] != 0:
-            rfirst = i
-            break
-    for i in range(rows - 1, rfirst, -1):
-        if imrsum[i] != 0:
-            rlast = i + 1
-            break
-    for i in range(cols):
-        if imcsum[i] != 0:
-            cfirst = i
-            break
-    for i in range(cols - 1, cfirst, -1):
-        if imcsum[i] != 0:
-            clast = i + 1
-            break
-
-    rfirst = max(rfirst - border, 0)
-    cfirst = max(cfirst - border, 0)
-    rlast = min(rlast + border, rows)
-    clast = min(clast + border, cols)
-
-    imout = Image.fromarray(imarrayfull[rfirst:rlast, cfirst:clast])
-
-    os.chdir(curdir)
-    os.environ['PATH'] = saveenv
-    warnings.simplefilter('default', Image.DecompressionBombWarning)
-    return imout
+            result = subprocess.run(['fc-match', '--format=%{family}\n%{file}',
+                                     font],
+                                    check=True, capture_output=True,
+                                    text=True)
+            (families, fontfile) = result.stdout.split('\n', maxsplit=1)
+            if font.lower() not in families.lower().split(','):
+                print('Warning: font %s not found, using %s (%s) instead'
+                      % (font, families, fontfile), file=sys.stderr)
+            fontfiles[font] = fontfile
+
+    return fontfiles[font]
+
+
+def hires_from_text_freetype(text, font, fontsize=10, rotation=0,
+                             res=1200, border=12, debug=False):
+    """Generate a high-res image of a given line of text using FreeType.
+
+    This takes the same arguments as hires_from_text and produces a
+    similar image, but renders the text within this process using
+    Pillow's FreeType support rather than running LuaLaTeX.  The font
+    is found using find_font_file, and the font size (in TeX points)
+    is rounded to a whole number of pixels.  The rotation is about the
+    centre of the line, and is anticlockwise as with LaTeX's rotatebox.
+
+    The debug argument is accepted for compatibility and ignored.
+
+    Returns the word image as a PIL Image.
+    """
+
+    text = text.strip()
+    if text == '':
+        return None
+
+    pxsize = max(1, round(fontsize * res / 72.27))
+    if (font, pxsize) not in ftfonts:
+        ftfonts[(font, pxsize)] = ImageFont.truetype(find_font_file(font),
+                                                     pxsize)
+    ftfont = ftfonts[(font, pxsize)]
+
+    # We leave a margin of border pixels around the ink; crop_hires will
+    # then trim the image to exactly this border
+    (left, top, right, bottom) = ftfont.getbbox(text)
+    im = Image.new('L', (right - left + 2 * border, bottom - top + 2 * border),
+                   color=255)
+    ImageDraw.Draw(im).text((border - left, border - top), text,
+                            font=ftfont, fill=0)
+    if rotation != 0:
+        im = im.rotate(rotation, resample=Image.BICUBIC, expand=True,
+                       fillcolor=255)
+
+    return crop_hires(np.asarray(im, dtype=np.uint8), border)
+
+
+renderers = {'lualatex': hires_from_text,
+             'freetype': hires_from_text_freetype}
+
+
+def crop_hires(imarrayfull, border):
+    """Crop a rendered line to the ink plus a border of border pixels
+
+    Unfortunately, the rendered image may have too much white space
+    around it, as the box may be larger than the actual text.
+    So we manually remove the requisite number of blank white
+    rows and columns.
+
+    The input is a 2-d uint8 array; returns a PIL Image, or None if
+    there is no ink at all.
+    """
+
+    # A row or column contains ink if its minimum is less than white;
+    # these reductions avoid making any full-size copies of the image.
+    inkrows = np.flatnonzero(imarrayfull.min(axis=1) < 255)
+    if len(inkrows) == 0:
+        return None
+    inkcols = np.flatnonzero(imarrayfull.min(axis=0) < 255)
+    rows, cols = imarrayfull.shape
+
+    rfirst = max(inkrows[0] - border, 0)
+    cfirst = max(inkcols[0] - border, 0)
+    rlast = min(inkrows[-1] + 1 + border, rows)
+    clast = min(inkcols[-1] + 1 + border, cols)
+
+    return Image.fromarray(imarrayfull[rfirst:rlast, cfirst:clast])
 
 
 def hires_to_lores(im, scale, binary=False,
                    threshold=128, dorandom=True, offset=(0, 0),
-                   exposure=0, noise=0, border=0):
+                   exposure=0, noise=0, border=0, rng=random,
+                   nprandom=np.random):
     """Scales a high-resolution image to a lower greyscale one
 
     The input (im) and output are both PIL Images.
@@ -177,90 +442,243 @@ def hires_to_lores(im, scale, binary=False,
     added *after* the averaging process and not before, otherwise it
     would be almost completely eliminated.  (It is also applied after
     exposure correction.)
-    """
 
-    (cols, rows) = im.size
-    imarray = np.full((rows + 2 * scale, cols + 2 * scale), 255,
-                      dtype=np.uint8)
-    imarray[scale:-scale, scale:-scale] = np.asarray(im, dtype=np.uint8)
+    The random offset is drawn from rng (by default the random module)
+    and the noise from nprandom (by default np.random); a random.Random
+    and an np.random.RandomState can be given instead to make the result
+    independent of any other use of random numbers.
+
+    The work is done by lores_array_from_hires; see that function
+    for the array-based version.
+    """
 
     if dorandom:
-        offr = random.randint(0, scale - 1)
-        offc = random.randint(0, scale - 1)
+        offr = rng.randint(0, scale - 1)
+        offc = rng.randint(0, scale - 1)
     else:
         (offr, offc) = offset
 
-    lowcols = math.ceil((cols - 1) / scale) + 1
+    lowarray = lores_array_from_hires(np.asarray(im, dtype=np.uint8), scale,
+                                      binary=binary, threshold=threshold,
+                                      offset=(offr, offc), exposure=exposure,
+                                      noise=noise, border=border,
+                                      nprandom=nprandom)
+    if lowarray is None:
+        return None
+    return Image.fromarray(lowarray)
+
+
+def hires_to_lores_batch(ims, scale, binary=False,
+                         threshold=128, dorandom=True, offsets=None,
+                         exposure=0, noise=0, border=0, rng=random,
+                         nprandom=np.random):
+    """Scales a list of high-resolution images to lower greyscale ones
+
+    The inputs (ims) can be PIL Images or 2-d uint8 NumPy arrays; the
+    output is a list of uint8 NumPy arrays, with None in place of any
+    image which turned out to be entirely white.
+
+    The parameters are as for hires_to_lores and are shared by all of
+    the images, except that if dorandom is False, offsets should be a
+    list of (row, column) offsets, one per image.  The random numbers
+    are drawn in the same order as calling hires_to_lores on each image
+    in turn, so the results are identical to doing that.
+    """
+
+    lowarrays = []
+    for i, im in enumerate(ims):
+        if dorandom:
+            offr = rng.randint(0, scale - 1)
+            offc = rng.randint(0, scale - 1)
+        elif offsets is None:
+            (offr, offc) = (0, 0)
+        else:
+            (offr, offc) = offsets[i]
+        lowarrays.append(
+            lores_array_from_hires(np.asarray(im, dtype=np.uint8), scale,
+                                   binary=binary, threshold=threshold,
+                                   offset=(offr, offc), exposure=exposure,
+                                   noise=noise, border=border,
+                                   nprandom=nprandom))
+
+    return lowarrays
+
+
+def block_sums(imarray, scale, offset):
+    """Sum the high-resolution pixels lying in each low-resolution pixel
+
+    The input is a 2-d uint8 array.  It is surrounded by a white
+    border of width scale, and the low-resolution pixel corners are
+    then at (offr + i * scale, offc + j * scale) in this bordered image,
+    where offset = (offr, offc).
+
+    Returns an int64 array of the block sums.
+    """
+
+    (rows, cols) = imarray.shape
+    (offr, offc) = offset
     lowrows = math.ceil((rows - 1) / scale) + 1
-    lowarray = np.empty((lowrows, lowcols), dtype=np.uint8)
+    lowcols = math.ceil((cols - 1) / scale) + 1
+
+    # The final block may run off the end of the bordered image; any
+    # such block only contains border pixels, so we make the bordered
+    # image large enough to hold every block in full.
+    padrows = max(rows + 2 * scale, offr + lowrows * scale)
+    padcols = max(cols + 2 * scale, offc + lowcols * scale)
+    padarray = np.full((padrows, padcols), 255, dtype=np.uint8)
+    padarray[scale:scale + rows, scale:scale + cols] = imarray
+
+    blocks = padarray[offr:offr + lowrows * scale,
+                      offc:offc + lowcols * scale]
+    return blocks.reshape(lowrows, scale, lowcols, scale).sum(
+        axis=(1, 3), dtype=np.int64)
+
+
+def lores_from_averages(avarray, binary=False, threshold=128,
+                        exposure=0, noisearray=None, border=0):
+    """Turn an array of low-resolution pixel averages into an image array
+
+    This applies the exposure, noise and thresholding described in
+    hires_to_lores, trims any white rows and columns from the edges and
+    adds a white border.  The noisearray, if given, must have the same
+    shape as avarray.
+
+    Returns a uint8 array, or None if the whole image is white.
+    """
+
+    av = avarray * (1 + 2 * exposure / 100)
+    if noisearray is not None:
+        av += noisearray
+    if binary:
+        lowarray = np.where(av < threshold, 0, 255).astype(np.uint8)
+    else:
+        lowarray = np.clip(np.rint(av), 0, 255).astype(np.uint8)
+
+    nonwhite = lowarray != 255
+    nonwhiterows = np.flatnonzero(nonwhite.any(axis=1))
+    if len(nonwhiterows) == 0:
+        # the whole image is white
+        return None
+    nonwhitecols = np.flatnonzero(nonwhite.any(axis=0))
+    lowarray = lowarray[nonwhiterows[0]:nonwhiterows[-1] + 1,
+                        nonwhitecols[0]:nonwhitecols[-1] + 1]
+
+    if border > 0:
+        lowarray = np.pad(lowarray, border, mode='constant',
+                          constant_values=255)
+
+    return lowarray
+
+
+def lores_array_from_hires(imarray, scale, binary=False, threshold=128,
+                           offset=(0, 0), exposure=0, noise=0, border=0,
+                           nprandom=np.random):
+    """Scales a high-resolution array to a lower greyscale one
+
+    This is the NumPy array version of hires_to_lores, taking a 2-d
+    uint8 array and a fixed offset, and returning a uint8 array (or
+    None if the whole image is white).  The noise is drawn from
+    nprandom, which is np.random unless otherwise specified.
+    """
+
+    avarray = block_sums(imarray, scale, offset) / (scale * scale)
     # The following is for numpy >= 1.17:
     # rng = np.random.default_rng()
-    # noisearray = noise * rng.standard_normal((lowrows, lowcols))
+    # noisearray = noise * rng.standard_normal(avarray.shape)
     # This works on numpy < 1.17
-    noisearray = noise * np.random.standard_normal((lowrows, lowcols))
-
-    for r in range(lowrows):
-        for c in range(lowcols):
-            av = np.average(
-                    imarray[offr + r * scale:offr + (r + 1) * scale,
-                            offc + c * scale:offc + (c + 1) * scale])
-            av *= 1 + 2 * exposure / 100
-            av += noisearray[r, c]
-            if binary:
-                if av < threshold:
-                    lowarray[r, c] = 0
-                else:
-                    lowarray[r, c] = 255
-            else:
-                lowarray[r, c] = np.clip(round(av), 0, 255)
-
-    checked = False
-    while not checked:
-        for j in range(lowcols):
-            if lowarray[0, j] != 255:
-                checked = True
-                break
-        else:
-            lowarray = np.delete(lowarray, 0, 0)
-            lowrows -= 1
-            if lowrows == 0:
-                # the whole image is white
-                return None
-
-    checked = False
-    while not checked:
-        for j in range(lowcols):
-            if lowarray[-1, j] != 255:
-                checked = True
-                break
-        else:
-            lowarray = np.delete(lowarray, -1, 0)
-            lowrows -= 1
-
-    checked = False
-    while not checked:
-        for i in range(lowrows):
-            if lowarray[i, 0] != 255:
-                checked = True
-                break
-        else:
-            lowarray = np.delete(lowarray, 0, 1)
-            lowcols -= 1
-
-    checked = False
-    while not checked:
-        for i in range(lowrows):
-            if lowarray[i, -1] != 255:
-                checked = True
-                break
-        else:
-            lowarray = np.delete(lowarray, -1, 1)
-            lowcols -= 1
+    noisearray = noise * nprandom.standard_normal(avarray.shape)
 
-    if border > 0:
-        lowarray = np.insert(lowarray, [0] * border + [lowrows] * border,
-                             255, axis=0)
-        lowarray = np.insert(lowarray, [0] * border + [lowcols] * border,
-                             255, axis=1)
+    return lores_from_averages(avarray, binary=binary, threshold=threshold,
+                               exposure=exposure, noisearray=noisearray,
+                               border=border)
+
+
+def variant_grid(scale, offsets=None, exposures=(0,), thresholds=(128,),
+                 noises=(0,), seeds=(None,)):
+    """Make a list of variant specifications for lores_variants
+
+    This is every combination of the given offsets, exposures,
+    thresholds, noise levels and noise seeds.  If offsets is None, then
+    all scale * scale phase offsets are used.  Each specification is a
+    dict with keys 'offset', 'exposure', 'threshold', 'noise' and 'seed'.
+    """
+
+    if offsets is None:
+        offsets = list(itertools.product(range(scale), repeat=2))
+    return [{'offset': offset, 'exposure': exposure,
+             'threshold': threshold, 'noise': noise, 'seed': seed}
+            for (offset, exposure, threshold, noise, seed)
+            in itertools.product(offsets, exposures, thresholds,
+                                 noises, seeds)]
+
+
+def lores_variants(imarray, scale, variants, binary=False, border=0,
+                   nprandom=np.random):
+    """Generate many low-resolution variants of one high-resolution array
+
+    The input is a 2-d uint8 array (or a PIL Image) and a list of
+    variant specifications, as produced by variant_grid.  Each
+    specification is a dict which may contain the keys 'offset' (default
+    (0, 0)), 'exposure' (default 0), 'threshold' (default 128, only used
+    if binary is True), 'noise' (default 0) and 'seed' (default None).
+    These have the same meanings as in hires_to_lores.
+
+    The noise for a given seed is drawn from np.random.RandomState(seed),
+    so the same seed gives the same noise pattern at every offset and
+    noise level.  If the seed is None, fresh noise is drawn from
+    nprandom (by default np.random) for that variant.
+
+    This is a generator, yielding (variant, lowarray) pairs in the order
+    of the variants; lowarray is None if that variant is entirely white.
+
+    The work is shared between the variants: a single summed-area table
+    of the bordered image gives the block sums for every offset, and the
+    block averages for each offset and the standard normal noise for
+    each seed are only computed once.
+    """
+
+    imarray = np.asarray(imarray, dtype=np.uint8)
+    (rows, cols) = imarray.shape
+    lowrows = math.ceil((rows - 1) / scale) + 1
+    lowcols = math.ceil((cols - 1) / scale) + 1
+
+    # This is large enough to hold every block at every offset; see
+    # block_sums.  The summed-area table has an extra zero row and column
+    # at the start.
+    padrows = max(rows + 2 * scale, scale - 1 + lowrows * scale)
+    padcols = max(cols + 2 * scale, scale - 1 + lowcols * scale)
+    padarray = np.full((padrows, padcols), 255, dtype=np.uint8)
+    padarray[scale:scale + rows, scale:scale + cols] = imarray
+    sumtable = np.zeros((padrows + 1, padcols + 1), dtype=np.int64)
+    np.cumsum(padarray, axis=0, dtype=np.int64, out=sumtable[1:, 1:])
+    np.cumsum(sumtable[1:, 1:], axis=1, out=sumtable[1:, 1:])
+
+    averages = {}
+    normals = {}
+    for variant in variants:
+        offset = tuple(variant.get('offset', (0, 0)))
+        if offset not in averages:
+            (offr, offc) = offset
+            corners = sumtable[np.ix_(offr + scale * np.arange(lowrows + 1),
+                                      offc + scale * np.arange(lowcols + 1))]
+            sums = (corners[1:, 1:] - corners[:-1, 1:]
+                    - corners[1:, :-1] + corners[:-1, :-1])
+            averages[offset] = sums / (scale * scale)
+
+        noise = variant.get('noise', 0)
+        seed = variant.get('seed')
+        if seed is None:
+            noisearray = noise * nprandom.standard_normal((lowrows, lowcols))
+        else:
+            if seed not in normals:
+                normals[seed] = np.random.RandomState(seed).standard_normal(
+                    (lowrows, lowcols))
+            noisearray = noise * normals[seed]
+
+        lowarray = lores_from_averages(
+            averages[offset], binary=binary,
+            threshold=variant.get('threshold', 128),
+            exposure=variant.get('exposure', 0),
+            noisearray=noisearray, border=border)
+        yield (variant, lowarray)
 
-    return Image.fromarray(lowarray)
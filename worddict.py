@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+A precompiled, memory-mapped version of the dictionary word list
+
+parse_hocr.py looks up each word it reads in the dictionary
+british-english-large to determine its dictconf.  Reading the word
+list into a set takes a noticeable time and over 10 MB of memory in
+every process which parses hOCR, and ocr_images.py may run many such
+processes at once.  Running this file as a script instead compiles the
+word list into an index file, british-english-large.index, which
+WordIndex memory-maps, so that it is read only on demand and shared
+between all of the processes through the page cache.
+
+The index holds exactly the words that parse_hocr.py would put in the
+set (each line of the word list, stripped and lowercased), in a hash
+table with open addressing:
+
+    header: magic, number of slots, number of words, and the size and
+            modification time of the word list it was built from
+    slots:  one unsigned int per slot, holding 1 + the offset of the
+            word within the words section, or 0 for an empty slot
+    words:  the UTF-8 encoded words, each followed by a newline
+
+A word is looked up by hashing it with CRC-32 and probing the slots in
+turn from that one until the word or an empty slot is found.  There
+are at least twice as many slots as words, so few slots are probed.
+The index uses the native byte order, so should be built on the
+machine which uses it.
+"""
+
+import os
+import sys
+import mmap
+import array
+import struct
+import tempfile
+import zlib
+
+magic = b'OCRWORDS'
+header = struct.Struct('=8sQQQq')
+
+
+def read_wordlist(wordlist):
+    """The set of words in wordlist, as parse_hocr.py reads them"""
+
+    words = set()
+    for word in open(wordlist):
+        words.add(word.strip().lower())
+    return words
+
+
+def encode(word):
+    return word.encode('utf-8', 'surrogatepass')
+
+
+def build_index(wordlist, index):
+    """Compile the word list file into the index file"""
+
+    st = os.stat(wordlist)
+    words = sorted(encode(word) for word in read_wordlist(wordlist))
+    nslots = 1
+    while nslots < 2 * len(words):
+        nslots *= 2
+
+    slots = array.array('I', [0]) * nslots
+    data = bytearray()
+    for word in words:
+        slot = zlib.crc32(word) & (nslots - 1)
+        while slots[slot]:
+            slot = (slot + 1) & (nslots - 1)
+        slots[slot] = len(data) + 1
+        data += word + b'\n'
+
+    # As with the caches, write the index atomically, so that other
+    # processes never see a partial index
+    indexdir = os.path.dirname(os.path.abspath(index))
+    fd, tmppath = tempfile.mkstemp(dir=indexdir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmpfile:
+            tmpfile.write(header.pack(magic, nslots, len(words),
+                                      st.st_size, st.st_mtime_ns))
+            tmpfile.write(slots.tobytes())
+            tmpfile.write(data)
+        os.chmod(tmppath, 0o644)
+        os.replace(tmppath, index)
+    except Exception:
+        os.remove(tmppath)
+        raise
+
+
+class WordIndex:
+    def __init__(self, index, wordlist=None):
+        """Memory-map the index file
+
+        If wordlist is given, an exception is raised if the index was
+        not built from the current version of it.
+        """
+
+        with open(index, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (mgc, nslots, self.nwords, size, mtime) = \
+            header.unpack_from(self.mm)
+        if mgc != magic:
+            raise Exception('%s is not a word index' % index)
+        if wordlist is not None:
+            st = os.stat(wordlist)
+            if (size, mtime) != (st.st_size, st.st_mtime_ns):
+                raise Exception('%s is out of date; rebuild it with '
+                                'worddict.py' % index)
+        self.mask = nslots - 1
+        slotsize = array.array('I').itemsize
+        self.slots = memoryview(self.mm)[
+            header.size:header.size + nslots * slotsize].cast('I')
+        self.wordbase = header.size + nslots * slotsize - 1
+
+    def __len__(self):
+        return self.nwords
+
+    def __contains__(self, word):
+        # The words in the index cannot contain newlines, and we must
+        # not match one word followed by the start of the next
+        if '\n' in word:
+            return False
+        key = encode(word) + b'\n'
+        slot = zlib.crc32(key[:-1]) & self.mask
+        while True:
+            offset = self.slots[slot]
+            if not offset:
+                return False
+            offset += self.wordbase
+            if self.mm[offset:offset + len(key)] == key:
+                return True
+            slot = (slot + 1) & self.mask
+
+
+if __name__ == '__main__':
+    import argparse
+
+    datapath = os.path.dirname(os.path.abspath(__file__))
+    wordlist = os.path.join(datapath, 'british-english-large')
+
+    arg_parser = argparse.ArgumentParser(
+        description='Compile the dictionary word list into an index')
+    arg_parser.add_argument('--check', action='store_true',
+                            help='Check that the index gives the same '
+                                 'results as the word list')
+    arg_parser.add_argument('wordlist', nargs='?', default=wordlist,
+                            help='Word list (default %s)' % wordlist)
+    arg_parser.add_argument('index', nargs='?', default=None,
+                            help='Index file (default the word list with '
+                                 '.index appended)')
+    args = arg_parser.parse_args()
+    index = args.index if args.index else args.wordlist + '.index'
+
+    build_index(args.wordlist, index)
+
+    if args.check:
+        words = read_wordlist(args.wordlist)
+        wordindex = WordIndex(index, args.wordlist)
+        missing = [w for w in words if w not in wordindex]
+        # each word with a character added or removed is a likely
+        # near miss for the hash table
+        extra = [w2 for w in words for w2 in [w + 'q', w[1:], w + '\n']
+                 if w2 not in words and w2 in wordindex]
+        if len(wordindex) != len(words) or missing or extra:
+            print('Index differs from word list: %d missing, %d extra' %
+                  (len(missing), len(extra)), file=sys.stderr)
+            sys.exit(1)
+        print('Index agrees with word list (%d words)' % len(words))